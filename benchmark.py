@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import logging
+import resource
+import time
+import tracemalloc
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+
+from mock_bot_api import add_mock_arguments, mock_from_args
+from main import broadcast
+
+
+class SendStats(BaseRequestMiddleware):
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.retries = 0
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ not in ("sendMessage", "sendPhoto"):
+            return await make_request(bot, method)
+
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            self.retries += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(args: argparse.Namespace):
+    mock = mock_from_args(args)
+    runner = await mock.start(args.host, args.port)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://{args.host}:{args.port}"))
+    bot = Bot(token="123456:MOCK-TOKEN", session=session)
+    stats = SendStats()
+    bot.session.middleware(stats)
+
+    users = [str(1_000_000 + i) for i in range(args.users)]
+    photo_file_id = "mock-photo" if args.photo else None
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        success, total = await broadcast(
+            bot, args.admin_chat, users, "<b>Benchmark</b>", photo_file_id, max_concurrent=args.concurrency
+        )
+    finally:
+        elapsed = time.perf_counter() - started
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        await bot.session.close()
+        await runner.cleanup()
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print("=" * 60)
+    print(f"Пользователей:        {total}")
+    print(f"Доставлено:           {success}")
+    print(f"Время:                {elapsed:.2f} сек")
+    print(f"Скорость:             {total / elapsed:.1f} сообщ/сек")
+    print(f"Задержка p50 / p99:   {stats.percentile(0.50) * 1000:.1f} / {stats.percentile(0.99) * 1000:.1f} мс")
+    print(f"Повторы (429):        {stats.retries}")
+    print(f"Пик памяти (Python):  {peak_traced / 1024 / 1024:.1f} МБ")
+    print(f"Пик RSS процесса:     {peak_rss_mb:.1f} МБ")
+    print(f"Mock API:             {mock.stats}")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки broadcast() против локального mock Bot API")
+    add_mock_arguments(parser)
+    parser.add_argument("--users", type=int, default=5000, help="количество синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=25, help="max_concurrent для broadcast()")
+    parser.add_argument("--admin-chat", type=int, default=1, help="чат для сообщения с прогрессом")
+    parser.add_argument("--photo", action="store_true", help="рассылать sendPhoto вместо sendMessage")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи рассылки")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    asyncio.run(run(args))
@@ -1,12 +1,15 @@
+import json
 import sqlite3
 import time
 from typing import List, Optional, Dict
 from datetime import datetime, timedelta, timezone
 
 DATABASE_NAME = 'database.db'
+ARCHIVE_DATABASE_NAME = 'archive.db'
+DB_TIMEOUT = 30 # сколько сек ждать блокировку записи, если БД занята другим процессом
 
 def connect_db():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT)
     conn.execute("PRAGMA journal_mode=WAL")
     return conn
 
@@ -147,7 +150,102 @@ def initialize_database():
         print('Таблица "autowithdrawals" создана')
     else:
         print('Выполнено подключение к таблице "autowithdrawals".')
-    
+
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="slots_daily_stats"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE slots_daily_stats (
+                day TEXT NOT NULL,
+                slots_value INTEGER NOT NULL,
+                spins INTEGER NOT NULL DEFAULT 0,
+                stars_played REAL NOT NULL DEFAULT 0,
+                stars_won REAL NOT NULL DEFAULT 0,
+                wins INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, slots_value)
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO slots_daily_stats (day, slots_value, spins, stars_played, stars_won, wins)
+            SELECT date(played_at, '+3 hours'), slots_value, COUNT(*), SUM(stars_played), SUM(won_stars),
+                   SUM(CASE WHEN won_stars > 0 THEN 1 ELSE 0 END)
+            FROM slots_logger
+            GROUP BY date(played_at, '+3 hours'), slots_value
+        """)
+        print('Таблица "slots_daily_stats" создана')
+    else:
+        print('Выполнено подключение к таблице "slots_daily_stats".')
+
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="slots_user_stats"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE slots_user_stats (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                spins INTEGER NOT NULL DEFAULT 0,
+                stars_played REAL NOT NULL DEFAULT 0,
+                stars_won REAL NOT NULL DEFAULT 0,
+                wins INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user_id)
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO slots_user_stats (day, user_id, spins, stars_played, stars_won, wins)
+            SELECT date(played_at, '+3 hours'), user_id, COUNT(*), SUM(stars_played), SUM(won_stars),
+                   SUM(CASE WHEN won_stars > 0 THEN 1 ELSE 0 END)
+            FROM slots_logger
+            GROUP BY date(played_at, '+3 hours'), user_id
+        """)
+        print('Таблица "slots_user_stats" создана')
+    else:
+        print('Выполнено подключение к таблице "slots_user_stats".')
+
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="broadcast_jobs"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                photo_file_id TEXT DEFAULT NULL,
+                buttons TEXT DEFAULT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                scheduled_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                created_at REAL DEFAULT (strftime('%s','now')),
+                started_at REAL DEFAULT NULL,
+                finished_at REAL DEFAULT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX idx_broadcast_jobs_queue ON broadcast_jobs (status, scheduled_at)")
+        print('Таблица "broadcast_jobs" создана')
+    else:
+        print('Выполнено подключение к таблице "broadcast_jobs".')
+
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="channel_members"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE channel_members (
+                channel_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                is_member INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, channel_id)
+            ) WITHOUT ROWID
+        """)
+        print('Таблица "channel_members" создана')
+    else:
+        print('Выполнено подключение к таблице "channel_members".')
+
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="bot_settings"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        print('Таблица "bot_settings" создана')
+    else:
+        print('Выполнено подключение к таблице "bot_settings".')
+
     conn.commit()
     conn.close()
     print('База данных успешно инициализирована.')
@@ -155,49 +253,136 @@ def initialize_database():
 initialize_database()
 
 def add_to_auto_withdrawals(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO autowithdrawals (user_id) VALUES (?)', (user_id,))
         conn.commit()
 
 def remove_from_auto_withdrawals(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM autowithdrawals WHERE user_id = ?', (user_id,))
         conn.commit()
 
 def check_auto(user_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM autowithdrawals WHERE user_id = ?', (user_id,))
         return bool(cursor.fetchone())
 
 def get_auto_withdrawals() -> list[int]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT user_id FROM autowithdrawals')
         return [row[0] for row in cursor.fetchall()]
 
+def msk_day(ts: float | None = None) -> str:
+    return datetime.fromtimestamp(ts if ts is not None else time.time(), MSK).strftime("%Y-%m-%d")
+
+def insert_slot_play(cursor, user_id, stars_spent, stars_won, slot_value, slot_text, status):
+    cursor.execute("""
+        INSERT INTO slots_logger (
+            user_id,
+            stars_played,
+            won_stars,
+            slots_value,
+            slots_text_value,
+            status_slot
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, stars_spent, stars_won, slot_value, slot_text, status))
+
+    day = msk_day()
+    win = 1 if stars_won > 0 else 0
+    cursor.execute("""
+        INSERT INTO slots_daily_stats (day, slots_value, spins, stars_played, stars_won, wins)
+        VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT (day, slots_value) DO UPDATE SET
+            spins = spins + 1,
+            stars_played = stars_played + excluded.stars_played,
+            stars_won = stars_won + excluded.stars_won,
+            wins = wins + excluded.wins
+    """, (day, slot_value, stars_spent, stars_won, win))
+    cursor.execute("""
+        INSERT INTO slots_user_stats (day, user_id, spins, stars_played, stars_won, wins)
+        VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT (day, user_id) DO UPDATE SET
+            spins = spins + 1,
+            stars_played = stars_played + excluded.stars_played,
+            stars_won = stars_won + excluded.stars_won,
+            wins = wins + excluded.wins
+    """, (day, user_id, stars_spent, stars_won, win))
+
 def log_slot_play(user_id, stars_spent, stars_won, slot_value, slot_text, status):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        insert_slot_play(cursor, user_id, stars_spent, stars_won, slot_value, slot_text, status)
+
+def settle_spin(user_id, cost, value, reward, text) -> Optional[float]:
+    status = "Выиграл" if reward > 0 else "Проиграл"
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE users SET stars = stars - ? + ? WHERE id = ? AND stars >= ?',
+            (cost, reward, user_id, cost)
+        )
+        if cursor.rowcount == 0:
+            return None
+
+        insert_slot_play(cursor, user_id, cost, reward, value, text, status)
+
+        balance = cursor.execute('SELECT stars FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+        conn.commit()
+        return balance
+
+def get_slots_summary(day_from: str, day_to: str) -> Dict:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        row = cursor.execute("""
+            SELECT COALESCE(SUM(spins), 0) AS spins,
+                   COALESCE(SUM(stars_played), 0) AS stars_played,
+                   COALESCE(SUM(stars_won), 0) AS stars_won,
+                   COALESCE(SUM(wins), 0) AS wins
+            FROM slots_daily_stats
+            WHERE day BETWEEN ? AND ?
+        """, (day_from, day_to)).fetchone()
+        return dict(row)
+
+def get_slots_value_stats(day_from: str, day_to: str) -> List[Dict]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT slots_value, SUM(spins) AS spins, SUM(wins) AS wins, SUM(stars_won) AS stars_won
+            FROM slots_daily_stats
+            WHERE day BETWEEN ? AND ? AND wins > 0
+            GROUP BY slots_value
+            ORDER BY stars_won DESC
+        """, (day_from, day_to))
+        return [dict(r) for r in cursor.fetchall()]
+
+def get_slots_top_winners(day_from: str, day_to: str, limit: int = 10) -> List[Dict]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO slots_logger (
-                user_id,
-                stars_played,
-                won_stars,
-                slots_value,
-                slots_text_value,
-                status_slot
-            ) VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, stars_spent, stars_won, slot_value, slot_text, status))
+            SELECT s.user_id, u.username, SUM(s.spins) AS spins,
+                   SUM(s.stars_won) - SUM(s.stars_played) AS profit
+            FROM slots_user_stats s
+            LEFT JOIN users u ON u.id = s.user_id
+            WHERE s.day BETWEEN ? AND ?
+            GROUP BY s.user_id
+            ORDER BY profit DESC
+            LIMIT ?
+        """, (day_from, day_to, limit))
+        return [dict(r) for r in cursor.fetchall()]
 
 def get_today_withdraw_top(limit: int = 10) -> list[tuple[str, int]]:
     now = datetime.now(MSK)
     start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
     start_ts = int(start_of_day.timestamp())
 
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT username, SUM(stars) AS total_stars
@@ -215,7 +400,7 @@ def get_week_withdraw_top(limit: int = 10) -> list[tuple[str, int]]:
     start_of_week = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
     start_ts = int(start_of_week.timestamp())
 
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT username, SUM(stars) AS total_stars
@@ -228,7 +413,7 @@ def get_week_withdraw_top(limit: int = 10) -> list[tuple[str, int]]:
         return cursor.fetchall()
 
 def add_channel(id_channel: str, link_invite: str = None):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute(
@@ -238,7 +423,7 @@ def add_channel(id_channel: str, link_invite: str = None):
         conn.commit()
 
 def get_all_channels():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM channels_op")
@@ -246,7 +431,7 @@ def get_all_channels():
 
 
 def get_channels_ids():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT id_channel FROM channels_op")
@@ -255,7 +440,7 @@ def get_channels_ids():
 
 
 def get_channel(id_channel: str):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM channels_op WHERE id_channel = ?", (id_channel,))
@@ -264,7 +449,7 @@ def get_channel(id_channel: str):
 
 
 def update_invite_link(id_channel: str, new_link: str):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE channels_op SET link_invite = ? WHERE id_channel = ?",
@@ -274,15 +459,58 @@ def update_invite_link(id_channel: str, new_link: str):
 
 
 def delete_channel(id_channel: str):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM channels_op WHERE id_channel = ?", (id_channel,))
+        cursor.execute("DELETE FROM channel_members WHERE channel_id = ?", (id_channel,))
+        conn.commit()
+
+def set_channel_member(channel_id: str, user_id: int, is_member: bool):
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO channel_members (channel_id, user_id, is_member, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, channel_id) DO UPDATE SET
+                is_member = excluded.is_member,
+                updated_at = excluded.updated_at
+        ''', (channel_id, user_id, int(is_member), time.time()))
         conn.commit()
 
+def get_channel_members(user_id: int, channel_ids: list[str], max_age: float) -> Dict[str, bool]:
+    if not channel_ids:
+        return {}
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" * len(channel_ids))
+        cursor.execute(f'''
+            SELECT channel_id, is_member FROM channel_members
+            WHERE user_id = ? AND channel_id IN ({placeholders}) AND updated_at >= ?
+        ''', (user_id, *channel_ids, time.time() - max_age))
+        return {channel_id: bool(is_member) for channel_id, is_member in cursor.fetchall()}
+
+
 
+def set_bot_setting(key: str, value):
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO bot_settings (key, value, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = excluded.value,
+                updated_at = excluded.updated_at
+        ''', (key, json.dumps(value), time.time()))
+        conn.commit()
+
+def get_bot_settings() -> Dict[str, object]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT key, value FROM bot_settings')
+        return {key: json.loads(value) for key, value in cursor.fetchall()}
 
 def get_user_log_html(user_id: int) -> str:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -337,7 +565,7 @@ def get_user_log_html(user_id: int) -> str:
     )
     
 def get_banned_user(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT banned FROM users WHERE id = ?", (user_id,))
         result = cursor.fetchone()
@@ -347,14 +575,14 @@ def get_banned_user(user_id):
             return 0
         
 def set_banned_user(user_id, banned):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET banned = ? WHERE id = ?", (banned, user_id))
         conn.commit()
         return True
 
 def add_photo(user_id: int, price: float, path_to_photo: str) -> int:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO photos (user_id, price, path_to_photo) VALUES (?, ?, ?)",
@@ -363,7 +591,7 @@ def add_photo(user_id: int, price: float, path_to_photo: str) -> int:
         return cursor.lastrowid
 
 def get_photo(photo_id: int) -> Optional[Dict]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM photos WHERE id = ?", (photo_id,))
@@ -371,7 +599,7 @@ def get_photo(photo_id: int) -> Optional[Dict]:
         return dict(row) if row else None
 
 def list_photos(only_unsold: bool = True) -> List[Dict]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         if only_unsold:
@@ -381,13 +609,13 @@ def list_photos(only_unsold: bool = True) -> List[Dict]:
         return [dict(r) for r in cursor.fetchall()]
 
 def delete_photo(photo_id: int) -> bool:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
         return cursor.rowcount > 0
 
 def mark_photo_purchased(photo_id: int) -> bool:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE photos SET purchased = 1 WHERE id = ? AND purchased = 0",
@@ -396,7 +624,7 @@ def mark_photo_purchased(photo_id: int) -> bool:
         return cursor.rowcount > 0
     
 def get_user_photos(user_id: int, only_unsold: bool = False) -> List[Dict]:
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         if only_unsold:
@@ -412,7 +640,7 @@ def get_user_photos(user_id: int, only_unsold: bool = False) -> List[Dict]:
         return [dict(r) for r in cursor.fetchall()]
 
 def add_withdrawale(username, user_id, stars, status='Ожидает обработки ⚙️'):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         created_at = int(datetime.now(MSK).timestamp())
         cursor.execute('''
@@ -423,24 +651,24 @@ def add_withdrawale(username, user_id, stars, status='Ожидает обраб
         return True, cursor.lastrowid
 
 def update_status_withdrawal(withdrawal_id, status):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE withdrawales SET status = ? WHERE id = ?', (status, withdrawal_id))
         conn.commit()
         return True
 
 def get_status_withdrawal(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         return cursor.execute('SELECT status FROM withdrawales WHERE user_id = ?', (user_id,)).fetchone()[0]
 
 def get_withdrawals(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         return cursor.execute('SELECT * FROM withdrawales WHERE user_id = ?', (user_id,)).fetchall()
 
 def add_promocode(code, stars, max_uses):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute('INSERT INTO promocodes (code, stars, max_uses) VALUES (?, ?, ?)',
@@ -452,7 +680,7 @@ def add_promocode(code, stars, max_uses):
         
 def get_all_promocodes():
     try:
-        with sqlite3.connect(DATABASE_NAME) as conn:
+        with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM promocodes")
@@ -464,7 +692,7 @@ def get_all_promocodes():
         return []
 
 def use_promocode(code, user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         try:
             promo = cursor.execute('''
@@ -508,89 +736,89 @@ def use_promocode(code, user_id):
             return False, f"❌ {str(e)}"
 
 def delete_promocode(code):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM promocodes WHERE code = ?', (code,))
         conn.commit()
 
 def deactivate_promocode(code):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE promocodes SET is_active = FALSE WHERE code = ?', (code,))
         conn.commit()
 
 def add_user(user_id, username, referral_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO users (id, username, referral_id) VALUES (?, ?, ?)', (user_id, username, referral_id))
         conn.commit()
 
 def get_total_withdrawn():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT SUM(withdrawn) FROM users')
         result = cursor.fetchone()[0]
         return result or 0.0
 
 def get_withdrawed(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         result = cursor.execute('SELECT withdrawn FROM users WHERE id = ?', (user_id,)).fetchone()
         return result[0]
 
 def get_total_photo_selling_count():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT SUM(count_photo_selling) FROM users')
         result = cursor.fetchone()[0]
         return result or 0
 
 def get_referral_count(user_id: int):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM users WHERE referral_id = ?', (user_id,))
         result = cursor.fetchone()[0]
         return result or 0
 
 def increment_count_photo_selling(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET count_photo_selling = count_photo_selling + 1 WHERE id = ?', (user_id,))
         conn.commit()
 
 def user_exists(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         result = cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
         return bool(result)
     
 def get_balance_user(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         result = cursor.execute('SELECT stars FROM users WHERE id = ?', (user_id,)).fetchone()
         return result[0]
 
 def get_photo_sell_count(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         result = cursor.execute('SELECT count_photo_selling FROM users WHERE id = ?', (user_id,)).fetchone()
         return result[0]
 
 def add_withdrawal(user_id, amount):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET withdrawn = withdrawn + ? WHERE id = ?', (amount, user_id))
         conn.commit()
 
 def get_count_users():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM users')
         return cursor.fetchone()[0]
 
 def get_users_ids():
     try:
-        with sqlite3.connect(DATABASE_NAME) as conn:
+        with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT id FROM users')
             return [str(row[0]) for row in cursor.fetchall()]
@@ -600,7 +828,7 @@ def get_users_ids():
         return []
 
 def get_banned_user(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         row = cursor.execute(
             'SELECT banned FROM users WHERE id = ?', 
@@ -609,13 +837,13 @@ def get_banned_user(user_id):
         return row[0] if row is not None else 0
 
 def add_stars(user_id, amount):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (amount, user_id))
         conn.commit()
 
 def remove_stars(user_id, amount):
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET stars = stars - ? WHERE id = ?', (amount, user_id))
         conn.commit()
@@ -624,3 +852,228 @@ def remove_stars(user_id, amount):
 
 
 
+
+
+def add_broadcast_job(admin_id, text, photo_file_id, buttons, scheduled_at, priority=0) -> int:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, text, photo_file_id, buttons, priority, scheduled_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (admin_id, text, photo_file_id, json.dumps(buttons, ensure_ascii=False) if buttons else None, priority, scheduled_at))
+        conn.commit()
+        return cursor.lastrowid
+
+def claim_next_broadcast_job(now: float) -> Optional[Dict]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        row = cursor.execute('''
+            SELECT * FROM broadcast_jobs
+            WHERE status = 'pending' AND scheduled_at <= ?
+            ORDER BY priority DESC, scheduled_at, id
+            LIMIT 1
+        ''', (now,)).fetchone()
+        if row is None:
+            return None
+
+        cursor.execute('''
+            UPDATE broadcast_jobs SET status = 'running', started_at = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (now, row["id"]))
+        conn.commit()
+        if cursor.rowcount == 0:
+            return None
+
+        job = dict(row)
+        job["status"] = "running"
+        job["buttons"] = json.loads(job["buttons"]) if job["buttons"] else []
+        return job
+
+def get_next_broadcast_time() -> Optional[float]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        return cursor.execute(
+            "SELECT MIN(scheduled_at) FROM broadcast_jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+
+def finish_broadcast_job(job_id: int, status: str, total: int, sent: int):
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcast_jobs SET status = ?, total = ?, sent = ?, finished_at = ?
+            WHERE id = ?
+        ''', (status, total, sent, time.time(), job_id))
+        conn.commit()
+
+def cancel_broadcast_job(job_id: int) -> bool:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled' WHERE id = ? AND status = 'pending'",
+            (job_id,)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+def list_broadcast_jobs(limit: int = 10) -> List[Dict]:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, priority, scheduled_at, status, total, sent, photo_file_id, substr(text, 1, 40) AS preview
+            FROM broadcast_jobs
+            WHERE status IN ('pending', 'running')
+            ORDER BY status = 'running' DESC, priority DESC, scheduled_at, id
+            LIMIT ?
+        ''', (limit,))
+        return [dict(r) for r in cursor.fetchall()]
+
+def mark_interrupted_broadcast_jobs() -> int:
+    with sqlite3.connect(DATABASE_NAME, timeout=DB_TIMEOUT) as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE broadcast_jobs SET status = 'interrupted' WHERE status = 'running'")
+        conn.commit()
+        return cursor.rowcount
+
+def archive_old_logs(max_age_days: int, batch_size: int = 5000) -> Dict[str, int]:
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+    moved = {"slots_logger": 0, "promocode_uses": 0}
+
+    conn = connect_db()
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DATABASE_NAME,))
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive.slots_logger (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                stars_played INTEGER NOT NULL,
+                won_stars INTEGER NOT NULL,
+                slots_value INTEGER NOT NULL,
+                slots_text_value TEXT NOT NULL,
+                status_slot TEXT NOT NULL,
+                played_at DATETIME NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive.promocode_uses (
+                id INTEGER PRIMARY KEY,
+                promocode_id INTEGER,
+                user_id INTEGER,
+                used_at TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        # Использования активных промокодов не трогаем — по ним проверяется повторная активация
+        jobs = {
+            "slots_logger": "played_at < ?",
+            "promocode_uses": """used_at < ? AND promocode_id NOT IN (
+                SELECT id FROM main.promocodes WHERE is_active AND current_uses < max_uses
+            )""",
+        }
+        for table, condition in jobs.items():
+            while True:
+                with conn:
+                    bound = conn.execute(f"""
+                        SELECT MAX(id) FROM (
+                            SELECT id FROM main.{table} WHERE {condition} ORDER BY id LIMIT ?
+                        )
+                    """, (cutoff, batch_size)).fetchone()[0]
+                    if bound is None:
+                        break
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO archive.{table}
+                        SELECT * FROM main.{table} WHERE id <= ? AND {condition}
+                    """, (bound, cutoff))
+                    deleted = conn.execute(
+                        f"DELETE FROM main.{table} WHERE id <= ? AND {condition}", (bound, cutoff)
+                    ).rowcount
+                    moved[table] += deleted
+
+        conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+    return moved
+
+def init_flood_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS flood_counters (
+            key TEXT NOT NULL,
+            window INTEGER NOT NULL,
+            hits INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (key, window)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+    return conn
+
+def write_flood_counters(conn: sqlite3.Connection, increments: Dict[tuple, tuple], now: float):
+    with conn:
+        conn.executemany("""
+            INSERT INTO flood_counters (key, window, hits, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key, window) DO UPDATE SET hits = hits + excluded.hits
+        """, [(key, window, hits, expires_at) for (key, window), (hits, expires_at) in increments.items()])
+        conn.execute("DELETE FROM flood_counters WHERE expires_at < ?", (now,))
+
+def read_flood_counters(conn: sqlite3.Connection, keys: List[str]) -> Dict[tuple, int]:
+    totals = {}
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        rows = conn.execute(
+            f"SELECT key, window, hits FROM flood_counters WHERE key IN ({','.join('?' * len(chunk))})",
+            chunk
+        ).fetchall()
+        for key, window, hits in rows:
+            totals[(key, window)] = hits
+    return totals
+
+def init_fsm_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=DB_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_records (
+            key TEXT PRIMARY KEY,
+            state TEXT DEFAULT NULL,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+    return conn
+
+def load_fsm_record(conn: sqlite3.Connection, key: str) -> Optional[tuple]:
+    row = conn.execute("SELECT state, data FROM fsm_records WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+def save_fsm_records(conn: sqlite3.Connection, records: Dict[str, tuple]) -> Dict[str, str]:
+    # Сериализуем до транзакции: одна запись с не-JSON данными не должна ронять всю пачку
+    now = time.time()
+    deleted, rows, skipped = [], [], {}
+    for key, (state, data) in records.items():
+        if state is None and not data:
+            deleted.append((key,))
+            continue
+        try:
+            rows.append((key, state, json.dumps(data, ensure_ascii=False), now))
+        except (TypeError, ValueError) as e:
+            skipped[key] = str(e)
+
+    with conn:
+        conn.executemany("DELETE FROM fsm_records WHERE key = ?", deleted)
+        conn.executemany("""
+            INSERT INTO fsm_records (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                state = excluded.state,
+                data = excluded.data,
+                updated_at = excluded.updated_at
+        """, rows)
+    return skipped
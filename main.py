@@ -4,21 +4,35 @@ import time
 import re
 import random
 import html
+import heapq
+import math
 import aiohttp
 import os
+import secrets
+import sqlite3
+import multiprocessing
+import itertools
 
-from aiohttp import ClientSession
-from collections import Counter
+from aiohttp import ClientSession, web
+from collections import Counter, OrderedDict
 from nudenet import NudeDetector
 from io import BytesIO
 from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from queue import Empty
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Callable, Dict, Any, Awaitable, Tuple
+from typing import Optional, Callable, Dict, Any, Awaitable, Tuple, Hashable
 from aiogram import Bot, Dispatcher, Router, types, F, BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import DeleteMessage, DeleteMessages
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.utils.text_decorations import HtmlDecoration
 from aiogram.filters import CommandStart, StateFilter
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, LabeledPrice, PreCheckoutQuery, BufferedInputFile, ChatMemberAdministrator, ChatInviteLink, LabeledPrice, PreCheckoutQuery
-from aiogram.types import File as TgFile
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, LabeledPrice, PreCheckoutQuery, BufferedInputFile, ChatMemberAdministrator, ChatInviteLink, LabeledPrice, PreCheckoutQuery
+from aiogram.types import File as TgFile, MessageId
 from aiogram.types.input_file import FSInputFile
 from aiogram.exceptions import (
     TelegramAPIError, TelegramBadRequest, TelegramNotFound, TelegramForbiddenError,
@@ -26,8 +40,11 @@ from aiogram.exceptions import (
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from PIL import Image, ImageDraw, ImageFont
+from slots_sim import get_combo_text, simulate_slots, format_report
 
 
 
@@ -72,10 +89,128 @@ def apply_watermark(
 
     return Image.alpha_composite(im.convert("RGBA"), layer).convert("RGB")
 
+class SlidingWindowLimiter:
+    def __init__(self, max_keys: int = 50_000, ttl: float = 600.0):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        # key -> [номер окна, счётчик текущего окна, счётчик прошлого окна, время последнего события]
+        self._windows: OrderedDict[tuple, list] = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._windows:
+            key, entry = next(iter(self._windows.items()))
+            if len(self._windows) <= self.max_keys and now - entry[3] < self.ttl:
+                break
+            del self._windows[key]
+
+    def hit(self, key: tuple, limit: int, period: float, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        window = int(now // period)
+
+        entry = self._windows.get(key)
+        if entry is None:
+            entry = [window, 0, 0, now]
+            self._windows[key] = entry
+        elif entry[0] != window:
+            entry[2] = entry[1] if entry[0] == window - 1 else 0
+            entry[1] = 0
+            entry[0] = window
+        self._windows.move_to_end(key)
+        entry[3] = now
+
+        elapsed = now - window * period
+        estimated = entry[2] * (1 - elapsed / period) + entry[1]
+        if estimated + 1 > limit:
+            self._evict(now)
+            return period - elapsed
+
+        entry[1] += 1
+        self._evict(now)
+        return 0.0
+
+    def __len__(self):
+        return len(self._windows)
+
+class SQLiteFloodBackend:
+    def __init__(self, path: str, flush_interval: float = 0.2, watch_ttl: float = 60.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.watch_ttl = watch_ttl
+        self._conn = init_flood_db(path)
+        # Локальные события копятся и пишутся в общую БД пачкой раз в flush_interval
+        self._pending: Dict[tuple, list] = {}
+        self._inflight: Dict[tuple, list] = {}
+        self._shared: Dict[tuple, int] = {}
+        self._watched: Dict[str, float] = {}
+
+    def _count(self, key: str, window: int) -> int:
+        count = self._shared.get((key, window), 0)
+        for local in (self._pending, self._inflight):
+            entry = local.get((key, window))
+            if entry:
+                count += entry[0]
+        return count
+
+    def hit(self, key: tuple, limit: int, period: float, now: float | None = None) -> float:
+        now = time.time() if now is None else now
+        name = f"{key[0]}:{key[1]}"
+        window = int(now // period)
+        self._watched[name] = now
+
+        elapsed = now - window * period
+        estimated = self._count(name, window - 1) * (1 - elapsed / period) + self._count(name, window)
+        if estimated + 1 > limit:
+            return period - elapsed
+
+        entry = self._pending.setdefault((name, window), [0, (window + 2) * period])
+        entry[0] += 1
+        return 0.0
+
+    async def flush(self):
+        now = time.time()
+        self._inflight, self._pending = self._pending, {}
+        self._watched = {name: seen for name, seen in self._watched.items() if now - seen < self.watch_ttl}
+        try:
+            await asyncio.to_thread(write_flood_counters, self._conn, self._inflight, now)
+        except Exception:
+            # Возвращаем в очередь только то, что точно не записано: повторная запись после коммита удвоила бы счётчики
+            for counter, entry in self._inflight.items():
+                pending = self._pending.setdefault(counter, [0, entry[1]])
+                pending[0] += entry[0]
+            self._inflight = {}
+            raise
+
+        try:
+            self._shared = await asyncio.to_thread(read_flood_counters, self._conn, list(self._watched))
+        finally:
+            self._inflight = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка синхронизации антифлуда: {e}")
+
+    def __len__(self):
+        return len(self._watched)
+
+def make_flood_backend() -> SlidingWindowLimiter | SQLiteFloodBackend:
+    if FLOOD_BACKEND == "sqlite":
+        return SQLiteFloodBackend(FLOOD_DATABASE_NAME)
+    return SlidingWindowLimiter()
+
 class AntiFloodMiddleware(BaseMiddleware):
-    def __init__(self, limit: int = 1):
-        self.limit = limit
-        self.last_time: Dict[int, float] = {}
+    def __init__(self, limits: Dict[str, tuple[int, float]], limiter: SlidingWindowLimiter | SQLiteFloodBackend | None = None):
+        self.limits = limits
+        self.limiter = limiter or SlidingWindowLimiter()
+
+    def scope(self, event: types.Message | types.CallbackQuery) -> str:
+        if isinstance(event, types.CallbackQuery):
+            name = (event.data or "").split(":")[0]
+            return name if name in self.limits else "callback"
+        return "message"
 
     async def __call__(
         self,
@@ -83,34 +218,204 @@ class AntiFloodMiddleware(BaseMiddleware):
         event: types.Message | types.CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
-        if isinstance(event, types.Message):
-            if event.text and event.text.startswith('/start'):
-                return await handler(event, data)
+        if isinstance(event, types.Message) and event.text and event.text.startswith('/start'):
+            return await handler(event, data)
+
+        scope = self.scope(event)
+        limit, period = self.limits[scope]
+        retry_after = self.limiter.hit((event.from_user.id, scope), limit, period)
+        if not retry_after:
+            return await handler(event, data)
+
+        warning = "⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(max(1, math.ceil(retry_after)))
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(warning, show_alert=True)
+        else:
+            await event.answer(warning)
+
+class UserLocks:
+    def __init__(self):
+        # user_id -> [замок, сколько обработчиков держат или ждут его]; запись удаляется, как только замок простаивает
+        self._locks: Dict[int, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
 
-            user_id = event.from_user.id
-            current_time = time.time()
+    def __len__(self):
+        return len(self._locks)
 
-            if user_id in self.last_time:
-                last_time = self.last_time[user_id]
-                if (current_time - last_time) < self.limit:
-                    await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(self.limit))
-                    return
+user_locks = UserLocks()
 
-            self.last_time[user_id] = current_time
+class UserLockMiddleware(BaseMiddleware):
+    def __init__(self, locks: UserLocks):
+        self.locks = locks
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Message | types.CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message | types.CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not get_flag(data, "user_lock"):
+            return await handler(event, data)
+        async with self.locks.hold(event.from_user.id):
             return await handler(event, data)
 
-        elif isinstance(event, types.CallbackQuery):
-            user_id = event.from_user.id
-            current_time = time.time()
+class RecentIds:
+    def __init__(self, capacity: int):
+        self._order: deque = deque()
+        self._ids: set = set()
+        self.capacity = capacity
+
+    def seen(self, key: Hashable) -> bool:
+        if key in self._ids:
+            return True
+        self._ids.add(key)
+        self._order.append(key)
+        if len(self._order) > self.capacity:
+            self._ids.discard(self._order.popleft())
+        return False
+
+class DedupMiddleware(BaseMiddleware):
+    def __init__(self, capacity: int):
+        self.recent = RecentIds(capacity)
+        self.dropped = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Update, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        duplicate = self.recent.seen(("update", event.update_id))
+        if event.callback_query:
+            duplicate = self.recent.seen(("callback", event.callback_query.id)) or duplicate
+        if duplicate:
+            self.dropped += 1
+            logging.info(f"Повторная доставка обновления {event.update_id} отброшена")
+            return
+        return await handler(event, data)
+
+PRIORITY_RANK = {"critical": 0, "high": 1, "normal": 2, "low": 3}
+
+def update_priority(update: types.Update) -> str:
+    if update.pre_checkout_query or (update.message and update.message.successful_payment):
+        return "critical"
+    # Пропущенное событие подписки оставит channel_members устаревшей, поэтому оно не отбрасывается
+    if update.chat_member:
+        return "high"
+    if update.callback_query:
+        name = (update.callback_query.data or "").split(":")[0]
+        if name in ("paid", "denied", "balk"):
+            return "high"
+        if name in LOW_PRIORITY_CALLBACKS:
+            return "low"
+    return "normal"
+
+class UpdateScheduler:
+    def __init__(self, concurrency: int, budgets: Dict[str, float | None]):
+        self.concurrency = concurrency
+        self.budgets = budgets
+        self.active = 0
+        self._heap: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.waiting = {name: 0 for name in PRIORITY_RANK}
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.shed = {name: 0 for name in PRIORITY_RANK}
+        self.max_wait = {name: 0.0 for name in PRIORITY_RANK}
+        self.max_depth = 0
+
+    async def acquire(self, priority: str) -> bool:
+        # Оплаты не ждут вовсе: ответ на pre_checkout_query должен уйти за 10 сек даже при флуде
+        if priority == "critical" or (self.active < self.concurrency and not self._heap):
+            self.active += 1
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (PRIORITY_RANK[priority], next(self._seq), future))
+        self.waiting[priority] += 1
+        self.max_depth = max(self.max_depth, len(self._heap))
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.budgets.get(priority))
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.shed[priority] += 1
+                return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            future.cancel()
+            raise
+        finally:
+            self.waiting[priority] -= 1
+            self.max_wait[priority] = max(self.max_wait[priority], time.monotonic() - started)
+        return True
+
+    def release(self):
+        self.active -= 1
+        while self._heap and self.active < self.concurrency:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def report(self) -> str:
+        waiting = ", ".join(f"{name}={count}" for name, count in self.waiting.items() if count)
+        shed = ", ".join(f"{name}={count}" for name, count in self.shed.items() if count)
+        max_wait = ", ".join(f"{name}={wait:.2f}с" for name, wait in self.max_wait.items() if wait)
+        return (
+            f"активно {self.active}/{self.concurrency}, в очереди [{waiting or '0'}], "
+            f"макс. очередь {self.max_depth}, макс. ожидание [{max_wait or '0'}], отброшено [{shed or '0'}]"
+        )
+
+update_scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_WAIT_BUDGET)
 
-            if user_id in self.last_time:
-                last_time = self.last_time[user_id]
-                if (current_time - last_time) < self.limit:
-                    await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(self.limit), show_alert=True)
-                    return
+class PriorityMiddleware(BaseMiddleware):
+    def __init__(self, scheduler: UpdateScheduler):
+        self.scheduler = scheduler
 
-            self.last_time[user_id] = current_time
+    async def __call__(
+        self,
+        handler: Callable[[types.Update, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not await self.scheduler.acquire(update_priority(event)):
+            if event.callback_query:
+                try:
+                    await data["bot"].answer_callback_query(
+                        event.callback_query.id, "⏳ Бот сейчас перегружен, попробуйте через пару секунд."
+                    )
+                except TelegramAPIError:
+                    pass
+            return
+        try:
             return await handler(event, data)
+        finally:
+            self.scheduler.release()
+
+async def scheduler_metrics_loop(interval: float = 60):
+    while True:
+        await asyncio.sleep(interval)
+        if update_scheduler.max_depth:
+            logging.warning(f"Очередь обновлений: {update_scheduler.report()}")
+            update_scheduler.reset_metrics()
 
 class SellState(StatesGroup):
     PRICE_PHOTO = State()
@@ -121,6 +426,7 @@ class AdminState(StatesGroup):
     ADD_PROMO_CODE = State()
     REMOVE_PROMO_CODE = State()
     MAILING = State()
+    MAILING_SCHEDULE = State()
     AWARDS = State()
     WITHDRAW = State()
     USERS_CHECK = State()
@@ -128,12 +434,395 @@ class AdminState(StatesGroup):
     REMOVE_OP = State()
     EDIT_SPIN_COST = State()
     EDIT_SLOT_REWARD = State()
+    SLOTS_CONFIRM = State()
     REMOVE_AUTO = State()
     ADD_AUTO = State()
     DEPOSIT = State()
 
 
-async def request_op(user_id, chat_id, first_name, language_code, bot: Bot, ref_id=None, gender=None, is_premium=None):
+class HttpSessions:
+    def __init__(self, pools: Dict[str, tuple[int, float]]):
+        self.pools = pools
+        self._sessions: Dict[str, ClientSession] = {}
+
+    def get(self, name: str) -> ClientSession:
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            limit_per_host, timeout = self.pools[name]
+            connector = aiohttp.TCPConnector(
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            session = ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 3)),
+            )
+            self._sessions[name] = session
+        return session
+
+    async def start(self):
+        for name in self.pools:
+            self.get(name)
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+http_sessions = HttpSessions(HTTP_POOLS)
+
+class BotMetadata:
+    def __init__(self, refresh_interval: float = 3600):
+        self.refresh_interval = refresh_interval
+        self.me: types.User | None = None
+
+    @property
+    def username(self) -> str:
+        return self.me.username if self.me else ""
+
+    @property
+    def url(self) -> str:
+        return f"https://t.me/{self.username}"
+
+    async def refresh(self, bot: Bot):
+        self.me = await bot.get_me()
+
+    async def run(self, bot: Bot):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh(bot)
+            except TelegramAPIError as e:
+                logging.error(f"Не удалось обновить данные бота: {e}")
+
+bot_metadata = BotMetadata()
+
+class RuntimeConfig:
+    # Настройки из админки хранятся в БД: воркеры перечитывают их раз в refresh_interval,
+    # поэтому изменение, сделанное в одном процессе, доходит до всех остальных
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.holders = {
+            "subgram_status": subgram_status,
+            "flyer_status": flyer_status,
+            "spin_cost": mini_games,
+            "stars_to_withdraw": stars_to_withdraw,
+            "photos_to_withdraw": photos_to_withdraw,
+            "stars_reffer": stars_reffer,
+        }
+
+    def apply(self, values: Dict[str, Any]):
+        for key, value in values.items():
+            if key == "slot_rewards":
+                reward_table = reward_games["slots"]["reward_table"]
+                reward_table.clear()
+                reward_table.update({int(slot_value): reward for slot_value, reward in value.items()})
+            elif key in self.holders:
+                self.holders[key][0] = value
+
+    def refresh(self):
+        self.apply(get_bot_settings())
+
+    def set(self, key: str, value: Any):
+        set_bot_setting(key, value)
+        self.apply({key: value})
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                # В потоке: занятая БД может держать блокировку до DB_TIMEOUT, цикл событий ждать не должен
+                self.apply(await asyncio.to_thread(get_bot_settings))
+            except sqlite3.Error as e:
+                logging.error(f"Не удалось перечитать настройки: {e}")
+
+runtime_config = RuntimeConfig(CONFIG_REFRESH_INTERVAL)
+
+class SentMessages:
+    def __init__(self, per_chat: int = 32, max_chats: int = 50_000):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, deque] = OrderedDict()
+
+    def add(self, chat_id: int, message_id: int):
+        ids = self._chats.get(chat_id)
+        if ids is None:
+            ids = self._chats[chat_id] = deque(maxlen=self.per_chat)
+        ids.append(message_id)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def discard(self, chat_id: int, message_ids: list[int]):
+        ids = self._chats.get(chat_id)
+        if not ids:
+            return
+        removed = set(message_ids)
+        self._chats[chat_id] = deque((i for i in ids if i not in removed), maxlen=self.per_chat)
+
+    def between(self, chat_id: int, first: int, last: int) -> list[int]:
+        return [i for i in self._chats.get(chat_id, ()) if first <= i <= last]
+
+sent_messages = SentMessages()
+
+send_priority: ContextVar[str] = ContextVar("send_priority", default="interactive")
+
+class SentMessagesMiddleware(BaseRequestMiddleware):
+    def __init__(self, sent: SentMessages):
+        self.sent = sent
+
+    async def __call__(self, make_request, bot: Bot, method):
+        result = await make_request(bot, method)
+        name = method.__api_method__
+        if name.startswith("send") or name in ("forwardMessage", "copyMessage"):
+            # Правки (editMessage*) id не добавляют, а рассылка не заводит окно на каждого получателя
+            if send_priority.get() != "bulk":
+                self.remember(method, result)
+        elif isinstance(method, DeleteMessage) and isinstance(method.chat_id, int):
+            self.sent.discard(method.chat_id, [method.message_id])
+        elif isinstance(method, DeleteMessages) and isinstance(method.chat_id, int):
+            self.sent.discard(method.chat_id, method.message_ids)
+        return result
+
+    def remember(self, method, result):
+        if isinstance(result, Message):
+            self.sent.add(result.chat.id, result.message_id)
+        elif isinstance(result, list):
+            for message in result:
+                self.sent.add(message.chat.id, message.message_id)
+        elif isinstance(result, MessageId) and isinstance(method.chat_id, int):
+            self.sent.add(method.chat_id, result.message_id)
+
+class OutboundPacer(BaseRequestMiddleware):
+    def __init__(self, rate: float, chat_limit: tuple[int, float], max_chats: int = 50_000):
+        self.rate = rate
+        self.chat_burst, self.chat_rate = chat_limit
+        self.max_chats = max_chats
+        self._tokens = float(rate)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+        # chat_id -> [замок очереди чата, токены, время пополнения, сколько отправок ждут]
+        self._chats: OrderedDict[int | str, list] = OrderedDict()
+
+    @staticmethod
+    def paced(method) -> bool:
+        name = method.__api_method__
+        if getattr(method, "chat_id", None) is None or name == "sendChatAction":
+            return False
+        return name.startswith("send") or name in ("copyMessage", "forwardMessage")
+
+    def _chat(self, chat_id: int | str) -> list:
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), float(self.chat_burst), time.monotonic(), 0]
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats and next(iter(self._chats.values()))[3] == 0:
+            self._chats.popitem(last=False)
+        return entry
+
+    async def _chat_permit(self, entry: list):
+        now = time.monotonic()
+        entry[1] = min(self.chat_burst, entry[1] + (now - entry[2]) * self.chat_rate)
+        entry[2] = now
+        if entry[1] < 1:
+            await asyncio.sleep((1 - entry[1]) / self.chat_rate)
+            entry[1], entry[2] = 1.0, time.monotonic()
+        entry[1] -= 1
+
+    def _refill(self, now: float):
+        self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    async def _global_permit(self, rank: int):
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (rank, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        try:
+            await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _pump(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if not self.paced(method):
+            return await make_request(bot, method)
+
+        rank = 0 if send_priority.get() == "interactive" else 1
+        entry = self._chat(method.chat_id)
+        entry[3] += 1
+        try:
+            # Замок чата честный (FIFO), поэтому сообщения в один чат уходят в порядке вызова
+            async with entry[0]:
+                await self._chat_permit(entry)
+                await self._global_permit(rank)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    raise
+        finally:
+            entry[3] -= 1
+
+def create_bot() -> Bot:
+    bot = Bot(token=TOKEN)
+    bot.session.middleware(SentMessagesMiddleware(sent_messages))
+    # Лимит Telegram общий на токен, а ведро у каждого процесса своё, поэтому делим его между воркерами
+    bot.session.middleware(OutboundPacer(OUTBOUND_RATE / max(WORKERS, 1), OUTBOUND_CHAT_LIMIT))
+    return bot
+
+async def delete_messages_batch(bot: Bot, chat_id: int, message_ids: list[int]):
+    # Один deleteMessages вместо серии delete_message; несуществующие id Telegram просто пропускает
+    ids = sorted(set(message_ids))
+    if not ids:
+        return
+    try:
+        await bot.delete_messages(chat_id=chat_id, message_ids=ids[-100:])
+    except TelegramAPIError as e:
+        print(f"Ошибка при удалении сообщений: {e}")
+
+class VerdictCache:
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._entries: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+
+    def get(self, provider: str, user_id: int) -> Any:
+        key = (provider, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def set(self, provider: str, user_id: int, verdict: Any, passed: bool):
+        ttl = gate_cache_ttl[0] if passed else gate_cache_negative_ttl[0]
+        if ttl <= 0:
+            return
+        key = (provider, user_id)
+        self._entries[key] = (time.monotonic() + ttl, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        for provider in ("subgram", "flyer"):
+            self._entries.pop((provider, user_id), None)
+
+gate_cache = VerdictCache()
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int, cooldown: float, fail_open: bool):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.fail_open = fail_open
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at < self.cooldown:
+            return False
+        # half-open: пропускаем один пробный запрос; если он завис или отменён, следующий пойдёт через cooldown
+        if self.state == "half-open" and now - self.probe_at < self.cooldown:
+            return False
+        self.state = "half-open"
+        self.probe_at = now
+        return True
+
+    def success(self):
+        if self.state != "closed":
+            logging.info(f"Circuit breaker {self.name}: провайдер снова доступен")
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.threshold:
+            if self.state == "closed":
+                logging.warning(f"Circuit breaker {self.name}: {self.failures} ошибок подряд, провайдер отключён на {self.cooldown} сек")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def describe(self) -> str:
+        mode = "пропуск" if self.fail_open else "блок"
+        if self.state == "closed":
+            return f"🟢 работает (ошибок подряд: {self.failures}, при сбое: {mode})"
+        if self.state == "half-open":
+            return f"🟡 пробный запрос (при сбое: {mode})"
+        left = max(0, math.ceil(self.cooldown - (time.monotonic() - self.opened_at)))
+        return f"🔴 отключён, проба через {left} сек (при сбое: {mode})"
+
+breakers = {name: CircuitBreaker(name, *config) for name, config in CIRCUIT_BREAKERS.items()}
+
+class ProviderError(Exception):
+    pass
+
+async def hedged(attempt: Callable[[], Awaitable[Any]], delay: float | None) -> Any:
+    # Если первый запрос не ответил за delay сек, параллельно отправляем второй и берём первый успешный ответ
+    tasks = [asyncio.create_task(attempt())]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks.append(asyncio.create_task(attempt()))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def fetch_op(user_id, chat_id, first_name, language_code, gender=None, is_premium=None) -> dict:
+    if gender is None:
+        cached = gate_cache.get("subgram", user_id)
+        if cached is not None:
+            return {"status": cached, "cached": True}
+
+    breaker = breakers["subgram"]
+    fallback = {"status": 'ok' if breaker.fail_open else 'unavailable', "cached": False}
+    if not breaker.allow():
+        return fallback
+
     headers = {
         'Content-Type': 'application/json',
         'Auth': f'{SUBGRAM_TOKEN}',
@@ -145,30 +834,140 @@ async def request_op(user_id, chat_id, first_name, language_code, bot: Bot, ref_
     if is_premium:
         data['Premium'] = is_premium
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post('https://api.subgram.ru/request-op-tokenless/', headers=headers, json=data) as response:
+    async def attempt() -> dict:
+        async with http_sessions.get("subgram").post('https://api.subgram.ru/request-op-tokenless/', headers=headers, json=data) as response:
             if not response.ok or response.status != 200:
-                logging.error("Ошибка при запросе SubGram. Если такая видишь такую ошибку - ставь другие настройки Subgram или проверь свой API KEY. Вот ошибка: %s" % str(await response.text()))
-                return 'ok'
-            response_json = await response.json()
-
-            if response_json.get('status') == 'warning':
-                if ref_id:
-                    await show_op(chat_id,response_json.get("links",[]), bot, ref_id=ref_id)
-                else:
-                    await show_op(chat_id,response_json.get("links",[]), bot)
-            elif response_json.get('status') == 'gender':
-                if ref_id:
-                    await show_gender(chat_id, bot, ref_id=ref_id)
-                else:
-                    await show_gender(chat_id, bot)
-            return response_json.get("status")
+                raise ProviderError(await response.text())
+            return await response.json()
+
+    try:
+        response_json = await hedged(attempt, HEDGE_DELAY.get("subgram"))
+    except ProviderError as e:
+        logging.error("Ошибка при запросе SubGram. Если такая видишь такую ошибку - ставь другие настройки Subgram или проверь свой API KEY. Вот ошибка: %s" % str(e))
+        breaker.failure()
+        return fallback
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.error(f"SubGram недоступен: {e!r}")
+        breaker.failure()
+        return fallback
+
+    breaker.success()
+
+    status = response_json.get("status")
+    gate_cache.set("subgram", user_id, status, status == 'ok')
+    return {"status": status, "links": response_json.get("links", []), "cached": False}
+
+async def show_op_result(result: dict, chat_id, bot: Bot, ref_id=None):
+    if result["cached"]:
+        return
+    if result["status"] == 'warning':
+        if ref_id:
+            await show_op(chat_id, result["links"], bot, ref_id=ref_id)
+        else:
+            await show_op(chat_id, result["links"], bot)
+    elif result["status"] == 'gender':
+        if ref_id:
+            await show_gender(chat_id, bot, ref_id=ref_id)
+        else:
+            await show_gender(chat_id, bot)
+    elif result["status"] == 'unavailable':
+        await bot.send_message(chat_id, "⚠️ Проверка спонсоров временно недоступна. Пожалуйста, попробуйте позже.")
+
+async def request_op(user_id, chat_id, first_name, language_code, bot: Bot, ref_id=None, gender=None, is_premium=None):
+    result = await fetch_op(user_id, chat_id, first_name, language_code, gender=gender, is_premium=is_premium)
+    await show_op_result(result, chat_id, bot, ref_id=ref_id)
+    return result["status"]
+
+GATE_BAN = ("ban",)
+GATE_FULL = ("ban", "subgram", "flyer")
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+
+    async def run(self, key: tuple, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+GATE_BLOCK_ALERTS = {
+    "warning": "📢 Сначала подпишитесь на каналы спонсоров",
+    "gender": "👤 Сначала выберите пол в сообщении выше",
+    "unavailable": "⚠️ Проверка спонсоров временно недоступна. Пожалуйста, попробуйте позже.",
+}
+
+class GateMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.flights = SingleFlight()
+
+    @staticmethod
+    async def check_subgram(event: types.CallbackQuery, bot: Bot) -> dict:
+        user = event.from_user
+        result = await fetch_op(
+            user.id, event.message.chat.id, user.first_name, user.language_code,
+            is_premium=getattr(user, 'is_premium', None)
+        )
+        await show_op_result(result, event.message.chat.id, bot)
+        return result
+
+    @staticmethod
+    async def answer_blocked(event: types.CallbackQuery, reason: str | None):
+        # По кэшированному отказу задание заново не отправляется, поэтому напоминаем алертом
+        try:
+            if reason:
+                text = GATE_BLOCK_ALERTS.get(reason, "⏳ Сначала выполните задание в сообщении выше")
+                await event.answer(text, show_alert=True)
+            else:
+                await event.answer()
+        except TelegramAPIError:
+            pass
+
+    async def __call__(
+        self,
+        handler: Callable[[types.CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: types.CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        policy = get_flag(data, "gate") or ()
+        user = event.from_user
+        bot: Bot = data["bot"]
+
+        if "ban" in policy and get_banned_user(user.id) == 1:
+            await event.answer("🚫 Вы заблокированы в боте!", show_alert=True)
+            return
+
+        if "subgram" in policy and subgram_status[0]:
+            result = await self.flights.run(("subgram", user.id), lambda: self.check_subgram(event, bot))
+            if result["status"] != 'ok':
+                await self.answer_blocked(event, result["status"] if result["cached"] else None)
+                return
+
+        if "flyer" in policy and flyer_status[0]:
+            cached = gate_cache.get("flyer", user.id) is not None
+            passed = await self.flights.run(("flyer", user.id), lambda: flyer_check(
+                key=FLYER_TOKEN, user_id=user.id, lang_code=user.language_code
+            ))
+            if passed is None:
+                await self.answer_blocked(event, "unavailable")
+                return
+            if not passed:
+                await self.answer_blocked(event, "warning" if cached else None)
+                return
+
+        return await handler(event, data)
 
 @router.callback_query(F.data.startswith("subgram-op"))
 async def subgram_op_callback(call: CallbackQuery, bot: Bot):
     try:
         user = call.from_user
         user_id = user.id
+        gate_cache.invalidate(user_id)
         ref_id = None
         
         args = call.data.split(':')
@@ -262,6 +1061,7 @@ async def gendergram(call: types.CallbackQuery, state: FSMContext, bot: Bot):
         ref_id = args[1]
     
     user_id = call.from_user.id
+    gate_cache.invalidate(user_id)
     chat_id = call.message.chat.id
     first_name = call.from_user.first_name
     language_code = call.from_user.language_code
@@ -298,6 +1098,7 @@ async def start_command(message: Message, bot: Bot):
     try:
         user = message.from_user
         user_id = user.id
+        gate_cache.invalidate(user_id)
         
         args = message.text.split()
 
@@ -322,24 +1123,7 @@ async def start_command(message: Message, bot: Bot):
             return
 
 
-        response = await request_op(
-                user_id=user_id,
-                chat_id=message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=referral_id,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-
-        channels = get_channels_ids()
-        if not await check_subscription(user_id, channels, bot, referral_id):
-            return
-
-        if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
+        if not await run_start_gates(user, message.chat.id, bot, referral_id):
             return
         
         builder_start = InlineKeyboardBuilder()
@@ -396,32 +1180,9 @@ async def start_command(message: Message, bot: Bot):
             parse_mode='HTML'
         )
 
-@router.callback_query(F.data == "photo_selling")
+@router.callback_query(F.data == "photo_selling", flags={"gate": GATE_FULL})
 async def photo_sellings(call: CallbackQuery, bot: Bot):
-    user = call.from_user
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
 
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
@@ -447,31 +1208,9 @@ async def photo_sellings(call: CallbackQuery, bot: Bot):
         parse_mode='HTML'
     )
 
-@router.callback_query(F.data == "buy_photo")
+@router.callback_query(F.data == "buy_photo", flags={"gate": GATE_FULL})
 async def buy_photo(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
@@ -490,7 +1229,7 @@ async def buy_photo(call: CallbackQuery, bot: Bot):
     photo_price = random_photo['price']
 
     original = Image.open(photo_path)
-    watermarked = apply_watermark(original, text=f"@{(await bot.get_me()).username}", font_path="arial.ttf")
+    watermarked = apply_watermark(original, text=f"@{bot_metadata.username}", font_path="arial.ttf")
     buf = BytesIO()
     watermarked.save(buf, format="JPEG")
     buf.seek(0)
@@ -525,13 +1264,9 @@ def delete_file(filepath):
     else:
         print(f"⚠️ Файл не найден: {filepath}")
 
-@router.callback_query(F.data.startswith("process_buy:"))
+@router.callback_query(F.data.startswith("process_buy:"), flags={"gate": GATE_BAN, "user_lock": True})
 async def process_buy(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
     photo_id = call.data.split(":")[1]
     photo = get_photo(photo_id)
@@ -600,30 +1335,9 @@ def is_nude(image_path, threshold=0.25):
     result = detector.detect(image_path)
     return any(obj['class'] in banned and obj['score'] > threshold for obj in result)
 
-@router.callback_query(F.data == "sell_photo")
+@router.callback_query(F.data == "sell_photo", flags={"gate": GATE_FULL})
 async def sell_photo(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
 
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
@@ -654,7 +1368,7 @@ async def sell_photo_price(message: Message, bot: Bot, state: FSMContext):
         await message.reply("❌ Цена должна быть от 1.0 до 5.0. Попробуйте ещё раз.")
         return
 
-    await state.update_data(price=price)
+    await state.update_data(price=price, price_message_id=message.message_id)
     await state.set_state(SellState.PHOTO)
     await message.answer("📸 <b>Отправьте фото:</b>", parse_mode='HTML')
 
@@ -690,12 +1404,12 @@ async def sell_photo_handle(message: Message, state: FSMContext, bot: Bot):
     price = data.get("price")
     add_photo(user_id, price, str(file_path))
 
-    for offset in range(4):
-        try:
-            await bot.delete_message(chat_id=user_id,
-                                     message_id=message.message_id - offset)
-        except TelegramBadRequest:
-            continue
+    price_message_id = data.get("price_message_id") or message.message_id - 2
+    await delete_messages_batch(bot, user_id, [
+        message.message_id,
+        price_message_id,
+        *sent_messages.between(user_id, price_message_id - 1, message.message_id),
+    ])
 
     markup_back = InlineKeyboardBuilder()
     markup_back.button(text="⬅️ В главное меню", callback_data="back_main")
@@ -710,30 +1424,9 @@ async def sell_photo_handle(message: Message, state: FSMContext, bot: Bot):
     )
     await state.clear()
 
-@router.callback_query(F.data == "stars_withdraw")
+@router.callback_query(F.data == "stars_withdraw", flags={"gate": GATE_FULL})
 async def withdraw_start(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
 
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
@@ -802,19 +1495,14 @@ def get_gift_id_by_emoji(emoji: str) -> str | None:
 async def get_bot_star_balance():
     url = f"https://api.telegram.org/bot{TOKEN}/getMyStarBalance"
 
-    async with ClientSession() as session:
-        async with session.get(url) as resp:
-            result = await resp.json()
-            return result['result']['amount']
+    async with http_sessions.get("telegram").get(url) as resp:
+        result = await resp.json()
+        return result['result']['amount']
 
 
-@router.callback_query(F.data.startswith("withdraw:"))
+@router.callback_query(F.data.startswith("withdraw:"), flags={"gate": GATE_BAN, "user_lock": True})
 async def withdraw_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
     username = call.from_user.username
     if username is None:
@@ -908,7 +1596,7 @@ async def denied_callback(call: CallbackQuery, bot: Bot):
             f"🔄 Статус: <b>Отказано 🚫</b>\n\n"
             f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
             f"<b><a href='{chater}'>Чат</a></b> | "
-            f"<b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>"
+            f"<b><a href='{bot_metadata.url}'>Бот</a></b>"
         )
 
         await safe_edit_message(bot, chahnel_withdraw_id, int(mesag_id), text, reason_markup)
@@ -938,7 +1626,7 @@ async def denied_reason_callback(call: CallbackQuery, bot: Bot):
             f"⚠️ Причина: <b>{reason_text}</b> \u200B\n\n"
             f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
             f"<b><a href='{chater}'>Чат</a></b> | "
-            f"<b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>"
+            f"<b><a href='{bot_metadata.url}'>Бот</a></b>"
         )
 
         await safe_edit_message(bot, chahnel_withdraw_id, int(mesag_id), text, None)
@@ -965,7 +1653,7 @@ async def paid_callback(call: CallbackQuery, bot: Bot):
                     "🔄 Статус: <b>Подарок отправлен 🎁</b>\n\n"
                     f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
                     f"<b><a href='{chater}'>Чат</a></b> | "
-                    f"<b><a href='https://t.me/{(await bot.me()).username}'>Бот</a></b>"
+                    f"<b><a href='{bot_metadata.url}'>Бот</a></b>"
                 ),
                 parse_mode='HTML',
                 disable_web_page_preview=True
@@ -995,7 +1683,8 @@ async def adminpanel_command(message: Message, bot: Bot):
         admin_builder.button(text='📄 Список ОП', callback_data='list_op')
         admin_builder.button(text='➖ Удалить ОП', callback_data='delete_op')
         admin_builder.button(text='📤 Рассылка', callback_data='mailing')
-        panel_admin = admin_builder.adjust(1, 1, 3, 3, 1, 3, 1).as_markup()
+        admin_builder.button(text='🗓 Очередь рассылок', callback_data='mailing_queue')
+        panel_admin = admin_builder.adjust(1, 1, 3, 3, 1, 3, 2).as_markup()
         await bot.send_message(message.from_user.id, f"<b>🎉 Вы вошли в панель администратора:</b>\n\n👥 Пользователей: {count_users}", parse_mode='HTML', reply_markup=panel_admin)
     else:
         await bot.send_message(message.from_user.id, "⚠️ Вы не администратор!", parse_mode='HTML')
@@ -1090,6 +1779,7 @@ async def delete_op_message(message: Message, state: FSMContext, bot: Bot):
     channel = message.text
     try:
         delete_channel(channel)
+        op_channels.invalidate()
     except:
         await bot.send_message(message.from_user.id, "❌ Ошибка!")
     await bot.send_message(message.from_user.id, "✅ Канал успешно удален!")
@@ -1162,6 +1852,7 @@ async def add_op_message(message: Message, state: FSMContext, bot: Bot):
     link = await create_invite_link(bot, channel, "OP_LINK")
     if link:
         add_channel(channel, link)
+        op_channels.invalidate()
         await bot.send_message(message.from_user.id, "✅ Канал успешно добавлен!")
     else:
         await bot.send_message(message.from_user.id, "❌ Не удалось создать ссылку.")
@@ -1236,7 +1927,8 @@ async def adminpanel_callback(call: CallbackQuery, bot: Bot):
         admin_builder.button(text='📄 Список ОП', callback_data='list_op')
         admin_builder.button(text='➖ Удалить ОП', callback_data='delete_op')
         admin_builder.button(text='📤 Рассылка', callback_data='mailing')
-        panel_admin = admin_builder.adjust(1, 1, 3, 3, 1, 3, 1).as_markup()
+        admin_builder.button(text='🗓 Очередь рассылок', callback_data='mailing_queue')
+        panel_admin = admin_builder.adjust(1, 1, 3, 3, 1, 3, 2).as_markup()
         await bot.send_message(call.from_user.id, f"<b>🎉 Вы вошли в панель администратора:</b>\n\n👥 Пользователей: {count_users}", parse_mode='HTML', reply_markup=panel_admin)
     else:
         await bot.send_message(call.from_user.id, "⚠️ Вы не администратор!", parse_mode='HTML')
@@ -1265,7 +1957,13 @@ async def config_changer(call: CallbackQuery, bot: Bot):
     
     await bot.send_message(
         call.message.chat.id,
-        "<b>🛠️ Изменить конфиг</b>\n\nВыберите раздел для изменения настроек:",
+        (
+            "<b>🛠️ Изменить конфиг</b>\n\n"
+            f"<blockquote>ℹ️ Subgram: {breakers['subgram'].describe()}\n"
+            f"🎉 Flyer: {breakers['flyer'].describe()}\n"
+            f"📥 Обновления: {update_scheduler.report()}</blockquote>\n\n"
+            "Выберите раздел для изменения настроек:"
+        ),
         parse_mode="HTML",
         reply_markup=markup_config
     )
@@ -1326,34 +2024,62 @@ async def show_slots_config(call_or_msg: Message | CallbackQuery, bot: Bot):
         )
 
 
+    builder.button(text="📊 Статистика слотов", callback_data="slots_stats")
     builder.button(text="⬅️ Назад", callback_data="config_games")
 
     markup = builder.adjust(1).as_markup()
 
+    report = await slots_report_text(mini_games[0], reward_games["slots"]["reward_table"])
+
     await bot.send_message(
         chat_id=user_id,
-        text="🎰 <b>Настройка игры: Слоты</b>\n\nВыберите, что хотите изменить:",
+        text=f"🎰 <b>Настройка игры: Слоты</b>\n\n{report}\n\nВыберите, что хотите изменить:",
         parse_mode="HTML",
         reply_markup=markup
     )
 
+async def slots_report_text(cost: int, reward_table: dict) -> str:
+    default_reward = reward_games["slots"].get("default_reward", 0)
+    report = await asyncio.to_thread(simulate_slots, cost, reward_table, default_reward)
+    return format_report(report)
+
+async def show_slots_preview(message: Message, state: FSMContext, cost: int, reward_table: dict, change_text: str):
+    current = await slots_report_text(mini_games[0], reward_games["slots"]["reward_table"])
+    preview = await slots_report_text(cost, reward_table)
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Сохранить", callback_data="slots_apply")
+    builder.button(text="❌ Отмена", callback_data="slots_discard")
+
+    await state.set_state(AdminState.SLOTS_CONFIRM)
+    await message.answer(
+        f"🧮 <b>Предпросмотр:</b> {change_text}\n\n"
+        f"<b>Сейчас:</b>\n{current}\n\n"
+        f"<b>После изменения:</b>\n{preview}",
+        parse_mode="HTML",
+        reply_markup=builder.adjust(2).as_markup()
+    )
+
 @router.callback_query(F.data == "edit_spin_cost")
 async def edit_spin_cost(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.delete_message(call.from_user.id, call.message.message_id)
     await bot.send_message(call.from_user.id, "💰 Введите новую стоимость прокрута в звёздах:")
     await state.set_state(AdminState.EDIT_SPIN_COST)
+    await state.set_data({})
 
 @router.message(AdminState.EDIT_SPIN_COST)
 async def save_spin_cost(message: Message, state: FSMContext, bot: Bot):
     text = message.text.strip()
-    if not text.isdigit():
+    if not text.isdigit() or int(text) == 0:
         await message.answer("❌ Введите корректное число (целое):")
+        return
 
-    mini_games[0] = int(text)
-    await message.answer(f"✅ Стоимость прокрута обновлена: {mini_games[0]} ⭐️")
-
-    await state.clear()
-    await show_slots_config(message, bot)
+    cost = int(text)
+    await state.update_data(pending_spin_cost=cost)
+    await show_slots_preview(
+        message, state, cost, reward_games["slots"]["reward_table"],
+        f"стоимость прокрута {mini_games[0]} ➝ {cost} ⭐"
+    )
 
 @router.callback_query(F.data.startswith("edit_slot_reward:"))
 async def edit_slot_reward(call: CallbackQuery, bot: Bot, state: FSMContext):
@@ -1364,7 +2090,7 @@ async def edit_slot_reward(call: CallbackQuery, bot: Bot, state: FSMContext):
         f"🎲 Введите новую награду для выпадения {value}:"
     )
     await state.set_state(AdminState.EDIT_SLOT_REWARD)
-    await state.update_data(editing_value=value)
+    await state.set_data({"editing_value": value})
 
 @router.message(AdminState.EDIT_SLOT_REWARD)
 async def save_slot_reward(message: Message, state: FSMContext, bot: Bot):
@@ -1375,12 +2101,81 @@ async def save_slot_reward(message: Message, state: FSMContext, bot: Bot):
 
     data = await state.get_data()
     value = data.get("editing_value")
+    reward = int(text)
+
+    reward_table = dict(reward_games["slots"]["reward_table"])
+    reward_table[value] = reward
+    await state.update_data(pending_slot_reward=[value, reward])
+    await show_slots_preview(
+        message, state, mini_games[0], reward_table,
+        f"награда за {' | '.join(get_combo_text(value))} ➝ {reward} ⭐"
+    )
 
-    reward_games["slots"]["reward_table"][value] = int(text)
-    await message.answer(f"✅ Награда для {value} обновлена: {int(text)} ⭐️")
-
+@router.callback_query(AdminState.SLOTS_CONFIRM, F.data.in_({"slots_apply", "slots_discard"}))
+async def confirm_slots_change(call: CallbackQuery, state: FSMContext, bot: Bot):
+    data = await state.get_data()
     await state.clear()
-    await show_slots_config(message, bot)
+
+    if call.data == "slots_apply":
+        if "pending_spin_cost" in data:
+            runtime_config.set("spin_cost", data["pending_spin_cost"])
+            await bot.answer_callback_query(call.id, f"✅ Стоимость прокрута обновлена: {mini_games[0]} ⭐️")
+        elif "pending_slot_reward" in data:
+            value, reward = data["pending_slot_reward"]
+            runtime_config.set("slot_rewards", {**reward_games["slots"]["reward_table"], value: reward})
+            await bot.answer_callback_query(call.id, f"✅ Награда для {value} обновлена: {reward} ⭐️")
+    else:
+        await bot.answer_callback_query(call.id, "❌ Изменение отменено")
+
+    await show_slots_config(call, bot)
+
+def format_slots_summary(title: str, summary: dict) -> str:
+    played = summary["stars_played"]
+    won = summary["stars_won"]
+    rtp = won / played * 100 if played else 0.0
+    return (
+        f"<b>{title}</b>\n"
+        f"<blockquote>🎰 Прокрутов: <b>{summary['spins']}</b> | Выигрышей: <b>{summary['wins']}</b>\n"
+        f"💸 Поставлено: <b>{played:.0f}</b> ⭐ | Выплачено: <b>{won:.0f}</b> ⭐\n"
+        f"🏦 Доход бота: <b>{played - won:+.0f}</b> ⭐ | RTP: <b>{rtp:.1f}%</b></blockquote>\n"
+    )
+
+@router.callback_query(F.data == "slots_stats")
+async def slots_stats_callback(call: CallbackQuery, bot: Bot):
+    if call.from_user.id not in admins_id:
+        await bot.answer_callback_query(call.id, "🚫 Вы не администратор!", show_alert=True)
+        return
+
+    now = datetime.now(MSK)
+    today = now.strftime("%Y-%m-%d")
+    week_start = (now - timedelta(days=now.weekday())).strftime("%Y-%m-%d")
+
+    text = "📊 <b>Статистика слотов</b>\n\n"
+    text += format_slots_summary("Сегодня", get_slots_summary(today, today))
+    text += format_slots_summary("С начала недели", get_slots_summary(week_start, today))
+
+    by_value = get_slots_value_stats(today, today)
+    if by_value:
+        text += "\n<b>Выигрыши сегодня по комбинациям:</b>\n"
+        for row in by_value:
+            text += f"{' | '.join(get_combo_text(row['slots_value']))} — {row['wins']} раз, {row['stars_won']:.0f} ⭐\n"
+
+    winners = get_slots_top_winners(week_start, today)
+    if winners:
+        text += "\n<b>🏆 Топ игроков недели (чистый выигрыш):</b>\n"
+        for i, row in enumerate(winners):
+            name = html.escape(row["username"]) if row["username"] else f"<code>{row['user_id']}</code>"
+            text += f"{i + 1}. {name} — {row['profit']:+.0f} ⭐ за {row['spins']} прокр.\n"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data="config_game:slots")
+
+    try:
+        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
+    except Exception as e:
+        print(f"Ошибка при удалении сообщения: {e}")
+
+    await bot.send_message(call.from_user.id, text, parse_mode="HTML", reply_markup=builder.as_markup())
 
 @router.callback_query(F.data.startswith("config_game:"))
 async def open_game_config(call: CallbackQuery, bot: Bot):
@@ -1398,7 +2193,7 @@ async def change_flyer(call: CallbackQuery, bot: Bot):
     except Exception as e:
         print(f"Не удалось удалить сообщение: {e}")
 
-    flyer_status[0] = not flyer_status[0]
+    runtime_config.set("flyer_status", not flyer_status[0])
     status_text = "включён ✅" if flyer_status[0] else "выключен ❌"
 
     builder = InlineKeyboardBuilder()
@@ -1423,7 +2218,7 @@ async def change_subgram(call: CallbackQuery, bot: Bot):
     except Exception as e:
         print(f"Не удалось удалить сообщение: {e}")
 
-    subgram_status[0] = not subgram_status[0]
+    runtime_config.set("subgram_status", not subgram_status[0])
     status_text = "включён ✅" if subgram_status[0] else "выключен ❌"
 
     builder = InlineKeyboardBuilder()
@@ -1455,8 +2250,8 @@ async def change_withdraw(message: Message, bot: Bot, state: FSMContext):
         stars, photo = message.text.split(':')
         stars = int(stars)
         photo = int(photo)
-        stars_to_withdraw[0] = stars
-        photos_to_withdraw[0] = photo
+        runtime_config.set("stars_to_withdraw", stars)
+        runtime_config.set("photos_to_withdraw", photo)
         await bot.send_message(message.from_user.id, "✅ Количество звёзд и фото успешно изменено!")
         await state.clear()
     except Exception as e:
@@ -1475,7 +2270,7 @@ async def change_awards(call: CallbackQuery, bot: Bot, state: FSMContext):
 async def change_awards(message: Message, bot: Bot, state: FSMContext):
     try:
         stars = int(message.text)
-        stars_reffer[0] = stars
+        runtime_config.set("stars_reffer", stars)
         await bot.send_message(message.from_user.id, "✅ Количество звёзд успешно изменено!")
         await state.clear()
     except Exception as e:
@@ -1620,19 +2415,21 @@ async def update_progress(
 
 async def broadcast(
     bot: Bot,
-    start_msg: types.Message,
+    chat_id: int,
     users: List[Tuple[int]],
     text: str,
     photo_file_id: str = None,
     keyboard=None,
-    max_concurrent: int = 25
-):
+    max_concurrent: int = 25,
+    progress: Dict[str, int] | None = None
+) -> tuple[int, int]:
     total_users = len(users)
     if not total_users:
-        await start_msg.reply("<b>❌ Нет пользователей для рассылки.</b>", parse_mode="HTML")
-        return
+        await bot.send_message(chat_id, "<b>❌ Нет пользователей для рассылки.</b>", parse_mode="HTML")
+        return 0, 0
 
-    progress_message = await start_msg.reply(
+    progress_message = await bot.send_message(
+        chat_id,
         "<b>📢 Статус рассылки:</b>\n\n"
         "Прогресс: <code>🟩⬜⬜⬜⬜⬜⬜⬜⬜⬜</code> <b>0%</b>\n"
         "Обработано: <b>0</b>/<b>{}</b>\n"
@@ -1684,6 +2481,7 @@ async def broadcast(
 
     async def process_user(user_id):
         nonlocal processed, success
+        send_priority.set("bulk")
         
         async with semaphore:
             result = await send_message_with_retry(
@@ -1694,6 +2492,8 @@ async def broadcast(
                 processed += 1
                 if result:
                     success += 1
+                    if progress is not None:
+                        progress["sent"] = success
                 
                 message_timestamps.append(time.time())
                 
@@ -1744,6 +2544,7 @@ async def broadcast(
         f"Рассылка завершена. Отправлено {success}/{total_users} сообщений за {elapsed_time:.1f} сек. "
         f"Средняя скорость: {final_speed:.1f} сообщ/сек"
     )
+    return success, total_users
 
 
 
@@ -1757,56 +2558,169 @@ async def mailing_handler(message: types.Message, state: FSMContext):
         text = message.text or ""
         entities = message.entities or []
         photo_file_id = None
-    users = get_users_ids()
 
     buttons = re.findall(r"\{([^{}]+)\}:([^{}]+)", text)
-    keyboard = None
     if buttons:
-        kb = InlineKeyboardBuilder()
-        for btn_text, btn_url in buttons:
-            kb.button(text=btn_text.strip(), url=btn_url.strip())
-        kb.adjust(1)
-        keyboard = kb.as_markup()
         text = re.sub(r"\{[^{}]+\}:([^{}]+)", "", text).strip()
 
     formatted_text = apply_html_formatting(text, entities)
 
-    logging.info(f"Начало рассылки для {len(users)} пользователей")
-    
-    await broadcast(
-        message.bot, message, users, formatted_text, photo_file_id, keyboard
+    await state.update_data(
+        mailing_text=formatted_text,
+        mailing_photo=photo_file_id,
+        mailing_buttons=[[btn_text.strip(), btn_url.strip()] for btn_text, btn_url in buttons]
+    )
+    await state.set_state(AdminState.MAILING_SCHEDULE)
+    await message.answer(
+        "<b>🗓 Когда запустить рассылку?</b>\n\n"
+        "<code>сейчас</code> — сразу, после уже запущенных рассылок\n"
+        "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code> — в указанное время (МСК)\n\n"
+        "<i>Через пробел можно указать приоритет (по умолчанию 0), например:</i> <code>25.10.2026 03:00 5</code>",
+        parse_mode='HTML'
+    )
+
+@router.message(AdminState.MAILING_SCHEDULE)
+async def mailing_schedule_handler(message: types.Message, state: FSMContext):
+    parts = (message.text or "").split()
+    try:
+        if parts and parts[0].lower() == "сейчас":
+            scheduled_at = time.time()
+            rest = parts[1:]
+        else:
+            scheduled_at = datetime.strptime(" ".join(parts[:2]), "%d.%m.%Y %H:%M").replace(tzinfo=MSK).timestamp()
+            rest = parts[2:]
+        priority = int(rest[0]) if rest else 0
+    except ValueError:
+        await message.answer("❌ Неверный формат. Пример: <code>сейчас</code> или <code>25.10.2026 03:00 5</code>", parse_mode='HTML')
+        return
+
+    data = await state.get_data()
+    job_id = add_broadcast_job(
+        message.from_user.id,
+        data["mailing_text"],
+        data.get("mailing_photo"),
+        data.get("mailing_buttons"),
+        scheduled_at,
+        priority
     )
     await state.clear()
+    broadcast_scheduler.notify()
+
+    start_text = datetime.fromtimestamp(scheduled_at, MSK).strftime("%d.%m.%Y %H:%M")
+    logging.info(f"Рассылка №{job_id} поставлена в очередь на {start_text} (приоритет {priority})")
+    await message.answer(
+        f"<b>✅ Рассылка №{job_id} добавлена в очередь</b>\n\n"
+        f"🕒 Старт: <b>{start_text}</b> (МСК)\n"
+        f"⚡ Приоритет: <b>{priority}</b>",
+        parse_mode='HTML'
+    )
+
+def build_mailing_keyboard(buttons: list) -> InlineKeyboardMarkup | None:
+    if not buttons:
+        return None
+    kb = InlineKeyboardBuilder()
+    for btn_text, btn_url in buttons:
+        kb.button(text=btn_text, url=btn_url)
+    kb.adjust(1)
+    return kb.as_markup()
+
+class BroadcastScheduler:
+    def __init__(self, poll_interval: float = 30.0):
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def _wait_next(self):
+        timeout = self.poll_interval
+        next_at = get_next_broadcast_time()
+        if next_at is not None:
+            timeout = min(timeout, max(0.0, next_at - time.time()))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run_job(self, bot: Bot, job: dict):
+        users = get_users_ids()
+        logging.info(f"Начало рассылки №{job['id']} для {len(users)} пользователей")
+        # Сколько уже доставлено, чтобы прерванная рассылка не записалась как пустая
+        progress = {"sent": 0}
+        try:
+            success, total = await broadcast(
+                bot, job["admin_id"], users, job["text"], job["photo_file_id"], build_mailing_keyboard(job["buttons"]),
+                progress=progress
+            )
+            finish_broadcast_job(job["id"], "done", total, success)
+        except asyncio.CancelledError:
+            finish_broadcast_job(job["id"], "interrupted", len(users), progress["sent"])
+            raise
+        except Exception as e:
+            logging.exception(f"Ошибка рассылки №{job['id']}: {e}")
+            finish_broadcast_job(job["id"], "failed", len(users), progress["sent"])
+
+    async def run(self, bot: Bot):
+        interrupted = mark_interrupted_broadcast_jobs()
+        if interrupted:
+            logging.warning(f"Рассылок прервано перезапуском: {interrupted}")
+
+        while True:
+            job = claim_next_broadcast_job(time.time())
+            if job is None:
+                await self._wait_next()
+                continue
+            await self._run_job(bot, job)
+
+broadcast_scheduler = BroadcastScheduler()
+
+@router.callback_query(F.data == "mailing_queue")
+async def mailing_queue_callback(call: CallbackQuery, bot: Bot):
+    if call.from_user.id not in admins_id:
+        await bot.answer_callback_query(call.id, "🚫 Вы не администратор!", show_alert=True)
+        return
+
+    await call.answer()
+    jobs = list_broadcast_jobs()
+    builder = InlineKeyboardBuilder()
+    text = "<b>🗓 Очередь рассылок:</b>\n\n"
+    for job in jobs:
+        start_text = datetime.fromtimestamp(job["scheduled_at"], MSK).strftime("%d.%m.%Y %H:%M")
+        status = "▶️ Идёт" if job["status"] == "running" else "⏳ Ожидает"
+        kind = "🖼" if job["photo_file_id"] else "💬"
+        text += (f"<b>№{job['id']}</b> {kind} {status}\n"
+                 f"🕒 {start_text} | ⚡ {job['priority']}\n"
+                 f"<i>{html.escape(job['preview'])}…</i>\n\n")
+        if job["status"] == "pending":
+            builder.button(text=f"❌ Отменить №{job['id']}", callback_data=f"mailing_cancel:{job['id']}")
+
+    if not jobs:
+        text += "<b>Пусто</b>"
+
+    builder.button(text="⬅️ В админ меню", callback_data="adminpanel")
+    await bot.send_message(call.from_user.id, text, parse_mode='HTML', reply_markup=builder.adjust(1).as_markup())
+
+@router.callback_query(F.data.startswith("mailing_cancel:"))
+async def mailing_cancel_callback(call: CallbackQuery, bot: Bot):
+    if call.from_user.id not in admins_id:
+        await bot.answer_callback_query(call.id, "🚫 Вы не администратор!", show_alert=True)
+        return
+
+    job_id = int(call.data.split(":")[1])
+    if cancel_broadcast_job(job_id):
+        await bot.answer_callback_query(call.id, f"✅ Рассылка №{job_id} отменена", show_alert=True)
+    else:
+        await bot.answer_callback_query(call.id, "⚠️ Рассылка уже запущена или завершена", show_alert=True)
 
 
 def apply_html_formatting(text, entities):
     return html_detect.unparse(text, entities)
 
 
-@router.callback_query(F.data == "profile")
+@router.callback_query(F.data == "profile", flags={"gate": GATE_FULL})
 async def profile_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
@@ -1844,30 +2758,10 @@ async def profile_callback(call: CallbackQuery, bot: Bot):
         reply_markup=markup_profile
     )
 
-@router.callback_query(F.data == "top")
+@router.callback_query(F.data == "top", flags={"gate": GATE_FULL})
 async def top_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
@@ -1895,30 +2789,10 @@ async def top_callback(call: CallbackQuery, bot: Bot):
         reply_markup=markup_top
     )
 
-@router.callback_query(F.data == "top_week")
+@router.callback_query(F.data == "top_week", flags={"gate": GATE_FULL})
 async def top_week_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
@@ -1946,19 +2820,15 @@ async def top_week_callback(call: CallbackQuery, bot: Bot):
         reply_markup=markup_top
     )
 
-@router.callback_query(F.data == "promocode")
+@router.callback_query(F.data == "promocode", flags={"gate": GATE_BAN})
 async def promocode_callback_query(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     await bot.delete_message(call.from_user.id, call.message.message_id)
     input_photo_promo = FSInputFile("photo/promocode.png")
     await bot.send_photo(call.from_user.id, photo=input_photo_promo, caption=f"✨ Для получения звезд на ваш баланс введите промокод:\n*<i>Найти промокоды можно в <a href='{channel_osn}'>канале</a> и <a href='{chater}'>чате</a></i>", parse_mode='HTML')
     await state.set_state(AdminState.PROMOCODE_INPUT)
 
-@router.message(AdminState.PROMOCODE_INPUT)
+@router.message(AdminState.PROMOCODE_INPUT, flags={"user_lock": True})
 async def promocode_handler(message: Message, state: FSMContext, bot: Bot):
     user_id = message.from_user.id
     markup_back_inline = InlineKeyboardBuilder()
@@ -1981,13 +2851,9 @@ async def promocode_handler(message: Message, state: FSMContext, bot: Bot):
     finally:
         await state.clear()
 
-@router.callback_query(F.data == "games")
+@router.callback_query(F.data == "games", flags={"gate": GATE_BAN})
 async def games_callback_query(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     try:
         await bot.delete_message(call.from_user.id, call.message.message_id)
     except Exception as e:
@@ -1995,14 +2861,9 @@ async def games_callback_query(call: CallbackQuery, bot: Bot):
 
     await send_games_menu(user_id, bot)
 
-@router.callback_query(F.data == "slots_game")
+@router.callback_query(F.data == "slots_game", flags={"gate": GATE_BAN})
 async def slots_game(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
     try:
         await bot.delete_message(call.from_user.id, call.message.message_id)
@@ -2011,14 +2872,9 @@ async def slots_game(call: CallbackQuery, bot: Bot):
 
     await send_slots_menu(user_id, bot)
 
-@router.callback_query(F.data == "slots_info")
+@router.callback_query(F.data == "slots_info", flags={"gate": GATE_BAN})
 async def slots_info(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
-
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
     builder = InlineKeyboardBuilder()
 
@@ -2052,33 +2908,56 @@ def get_slot_reward(value: int) -> int:
     reward_table = config.get("reward_table", {})
     return reward_table.get(value, config.get("default_reward", 0))
 
-def get_combo_text(dice_value: int) -> list[str]:
-    symbols = ["BAR", "🍇", "🍋", "7️⃣"]
-    dice_value -= 1
-    result = []
-
-    for _ in range(3):
-        result.append(symbols[dice_value % 4])
-        dice_value //= 4
 
-    return result[::-1]
-
-
-@router.callback_query(F.data == "spin_slot")
+class DelayedSender:
+    def __init__(self, max_concurrent: int = 20):
+        self._heap: list[tuple] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks: set[asyncio.Task] = set()
+
+    def schedule(self, delay: float, func: Callable[..., Awaitable[Any]], *args, **kwargs):
+        self._seq += 1
+        heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, func, args, kwargs))
+        self._wakeup.set()
+
+    async def _send(self, func, args, kwargs):
+        async with self._semaphore:
+            try:
+                await func(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Ошибка отложенной отправки: {e}")
+
+    async def run(self):
+        while True:
+            timeout = None
+            if self._heap:
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout <= 0:
+                    _, _, func, args, kwargs = heapq.heappop(self._heap)
+                    task = asyncio.create_task(self._send(func, args, kwargs))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+delayed_sender = DelayedSender()
+
+@router.callback_query(F.data == "spin_slot", flags={"gate": GATE_BAN, "user_lock": True})
 async def spin_slot(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    banned = get_banned_user(user_id)
 
     if not mini_games:
         await bot.answer_callback_query(call.id, "🚫 Ошибка: настройки мини-игры не найдены!", show_alert=True)
         return
     
     stars_to_play = mini_games[0]
-
-
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
     
     if get_balance_user(user_id) < stars_to_play:
         await bot.answer_callback_query(call.id, "🚫 У вас недостаточно звёзд!", show_alert=True)
@@ -2093,11 +2972,10 @@ async def spin_slot(call: CallbackQuery, bot: Bot):
 
     value = dice_msg.dice.value
     # print("[debug] Выпало: ", value)
-    slot_text = slot_text = " | ".join(get_combo_text(value))
+    slot_text = " | ".join(get_combo_text(value))
     reward = get_slot_reward(value)
     # print("[debug] Награда: ", reward)
 
-    await asyncio.sleep(2)
     builder = InlineKeyboardBuilder()
 
     buttons = [
@@ -2109,27 +2987,31 @@ async def spin_slot(call: CallbackQuery, bot: Bot):
 
     markup = builder.adjust(1).as_markup()
 
-    remove_stars(user_id, stars_to_play)
-
+    balance = settle_spin(user_id, stars_to_play, value, reward, slot_text)
 
-    if reward > 0:
-        log_slot_play(user_id, stars_to_play, reward, value, slot_text, "Выиграл")
-        await bot.send_message(
-            user_id,
-            f'🎁 <b>Вы выиграли!</b>\n\n<i>Ваш выигрыш составил: <span class="tg-spoiler">{reward} ⭐️</span></i>',
-            parse_mode='HTML',
-            reply_markup=markup
+    if balance is None:
+        result_text = "<b>🚫 У вас недостаточно звёзд!</b>\n\n<i>Прокрут не засчитан, звёзды не списаны.</i>"
+    elif reward > 0:
+        result_text = (
+            f'🎁 <b>Вы выиграли!</b>\n\n<i>Ваш выигрыш составил: <span class="tg-spoiler">{reward} ⭐️</span></i>\n'
+            f'💸 Баланс: <b>{balance:.2f}</b> ⭐️'
         )
-        add_stars(user_id, reward)
     else:
-        log_slot_play(user_id, stars_to_play, 0, value, slot_text, "Проиграл")
-        await bot.send_message(
-            user_id,
-            "<b>😢 К сожалению, вы проиграли.</b>\n\n<i>Попробуйте ещё раз!</i>",
-            parse_mode='HTML',
-            reply_markup=markup
+        result_text = (
+            "<b>😢 К сожалению, вы проиграли.</b>\n\n<i>Попробуйте ещё раз!</i>\n"
+            f"💸 Баланс: <b>{balance:.2f}</b> ⭐️"
         )
 
+    # Результат уже зачислен, сообщение ждёт окончания анимации барабана без удержания хендлера
+    delayed_sender.schedule(
+        slot_result_delay,
+        bot.send_message,
+        user_id,
+        result_text,
+        parse_mode='HTML',
+        reply_markup=markup
+    )
+
 
 async def send_slots_menu(user_id: int, bot: Bot):
     builder = InlineKeyboardBuilder()
@@ -2183,14 +3065,11 @@ async def send_main_menu(
     call: CallbackQuery | Message | None = None
 ) -> None:
     if call is not None:
-        try:
-            chat_id = call.from_user.id
-            message_id = call.message.message_id if isinstance(call, CallbackQuery) else call.message_id
-            await bot.delete_message(chat_id=chat_id, message_id=message_id - 1)
-            await bot.delete_message(chat_id=chat_id, message_id=message_id)
-            await bot.delete_message(chat_id=chat_id, message_id=message_id + 1)
-        except Exception as e:
-            print(f"Ошибка при удалении сообщения: {e}")
+        chat_id = call.from_user.id
+        message_id = call.message.message_id if isinstance(call, CallbackQuery) else call.message_id
+        await delete_messages_batch(
+            bot, chat_id, [message_id, *sent_messages.between(chat_id, message_id - 1, message_id + 1)]
+        )
     builder = InlineKeyboardBuilder()
     buttons = [
         ('🎰 Мини-Игры', 'games'),
@@ -2230,38 +3109,16 @@ async def send_main_menu(
         reply_markup=markup
     )
 
-@router.callback_query(F.data == "get_ref")
+@router.callback_query(F.data == "get_ref", flags={"gate": GATE_FULL})
 async def get_url_callback(call: CallbackQuery, bot: Bot):
-
     user_id = call.from_user.id
-    user = call.from_user
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
-
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=user_id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user_id, lang_code=user.language_code):
-        return
 
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
         print(f"Ошибка при удалении сообщения: {e}")
 
-    url = await create_url_referral(bot, user_id)
+    url = create_url_referral(user_id)
     markup_back_inline = InlineKeyboardBuilder()
     markup_back_inline.button(text="📤 Поделиться ссылкой", url=f"https://t.me/share/url?url={url}")
     markup_back_inline.button(text="⬅️ В главное меню", callback_data="back_main")
@@ -2275,24 +3132,8 @@ async def get_url_callback(call: CallbackQuery, bot: Bot):
         reply_markup=markup_back
     )
 
-@router.callback_query(F.data == "back_main")
+@router.callback_query(F.data == "back_main", flags={"gate": GATE_FULL})
 async def back_main(call: CallbackQuery, bot: Bot):
-    user = call.from_user
-    if subgram_status[0]:
-        response = await request_op(
-                user_id=call.from_user.id,
-                chat_id=call.message.chat.id,
-                first_name=user.first_name,
-                language_code=user.language_code,
-                bot=bot,
-                ref_id=None,
-                is_premium=getattr(user, 'is_premium', None)
-            )
-
-        if response != 'ok':
-            return
-    if flyer_status[0] and not await flyer_check(key=FLYER_TOKEN, user_id=user.id, lang_code=user.language_code):
-        return
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
@@ -2336,26 +3177,23 @@ async def back_main(call: CallbackQuery, bot: Bot):
             reply_markup=markup
         )
 
-@router.callback_query(F.data.startswith("check_subs"))
+@router.callback_query(F.data.startswith("check_subs"), flags={"gate": GATE_BAN})
 async def check_subs_callback(call: CallbackQuery, bot: Bot):
     user = call.from_user
     user_id = call.from_user.id
+    gate_cache.invalidate(user_id)
     refferal_id = None
     try:
         refferal_id = int(call.data.split(":")[1])
     except IndexError:
         pass
-    banned = get_banned_user(user_id)
-    if banned == 1:
-        await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
-        return
 
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     except Exception as e:
         print(f"Ошибка при удалении сообщения: {e}")
     
-    channels = get_channels_ids()
+    channels = op_channels.ids()
     
 
     if await check_subscription(user_id, channels, bot, refferal_id):
@@ -2407,87 +3245,198 @@ async def check_subs_callback(call: CallbackQuery, bot: Bot):
     else:
         await bot.answer_callback_query(call.id, "❌ Подписка не найдена")
 
-async def check_subscription(user_id: int, channel_ids: list, bot: Bot, referral_id: str = None) -> bool:
-    if not channel_ids:
-        return True
+class ChannelDirectory:
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._links: Dict[str, str | None] | None = None
+        self._loaded_at = 0.0
 
-    builder = InlineKeyboardBuilder()
+    def _load(self) -> Dict[str, str | None]:
+        if self._links is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._links = {row['id_channel']: row['link_invite'] for row in get_all_channels()}
+            self._loaded_at = time.monotonic()
+        return self._links
 
-    for channel_id in channel_ids:
+    def ids(self) -> list[str]:
+        return list(self._load())
+
+    def link(self, channel_id: str) -> str | None:
+        return self._load().get(channel_id)
+
+    def invalidate(self):
+        self._links = None
+
+    def __contains__(self, channel_id: str) -> bool:
+        return channel_id in self._load()
+
+op_channels = ChannelDirectory()
+
+def is_joined(chat_member) -> bool:
+    return chat_member.status in ('member', 'administrator', 'creator') or bool(getattr(chat_member, 'is_member', False))
+
+@router.chat_member()
+async def op_member_update(event: ChatMemberUpdated):
+    channel_id = str(event.chat.id)
+    if channel_id not in op_channels:
+        return
+    set_channel_member(channel_id, event.new_chat_member.user.id, is_joined(event.new_chat_member))
+
+async def fetch_member(user_id: int, channel_id: str, bot: Bot, limiter: asyncio.Semaphore) -> bool:
+    async with limiter:
+        chat_member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+
+    # Сохраняем только подписку: об отписке придёт chat_member, а "не подписан" из API
+    # устарел бы сразу после подписки, если бот не получает обновления канала
+    joined = is_joined(chat_member)
+    if joined:
+        set_channel_member(channel_id, user_id, True)
+    return joined
+
+async def fetch_subscription(user_id: int, channel_ids: list, bot: Bot) -> list[str] | None:
+    # Доверяем только сохранённой подписке: событие о вступлении могло потеряться, поэтому отписку перепроверяем через API
+    known = {channel_id: True for channel_id, joined in get_channel_members(user_id, channel_ids, op_member_ttl[0]).items() if joined}
+    unknown = [channel_id for channel_id in channel_ids if channel_id not in known]
+    if unknown:
+        limiter = asyncio.Semaphore(op_check_concurrency)
         try:
-            chat_member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                invite_link = get_channel(channel_id)
-                subscribe_button = InlineKeyboardButton(text="Подписаться", url=invite_link['link_invite'])
-                builder.add(subscribe_button)
+            joined = await asyncio.gather(*(fetch_member(user_id, channel_id, bot, limiter) for channel_id in unknown))
         except Exception as e:
             print(f"Ошибка при проверке подписки: {e}")
-            await bot.send_message(user_id, "Ошибка при проверке подписки. Пожалуйста, попробуйте позже.")
+            return None
+        known.update(zip(unknown, joined))
+    return [channel_id for channel_id in channel_ids if not known[channel_id]]
+
+async def show_subscription_prompt(user_id: int, missing: list[str] | None, bot: Bot, referral_id: str = None):
+    if missing is None:
+        await bot.send_message(user_id, "Ошибка при проверке подписки. Пожалуйста, попробуйте позже.")
+        return
+
+    builder = InlineKeyboardBuilder()
+    for channel_id in missing:
+        subscribe_button = InlineKeyboardButton(text="Подписаться", url=op_channels.link(channel_id))
+        builder.add(subscribe_button)
+
+    markup: InlineKeyboardMarkup = builder.as_markup()
+    check_data = f"check_subs:{referral_id}" if referral_id else "check_subs"
+    check_button = InlineKeyboardButton(text="✅ Проверить подписку", callback_data=check_data)
+    markup.inline_keyboard.append([check_button])
+
+    await bot.send_photo(
+        chat_id=user_id,
+        photo=FSInputFile('photo/check_sub.png'),
+        caption="<b>👋🏻 Добро пожаловать\n\nПодпишитесь на каналы, чтобы продолжить!</b>",
+        parse_mode='HTML',
+        reply_markup=markup
+    )
+
+async def check_subscription(user_id: int, channel_ids: list, bot: Bot, referral_id: str = None) -> bool:
+    if not channel_ids:
+        return True
+
+    missing = await fetch_subscription(user_id, channel_ids, bot)
+    if missing == []:
+        return True
+
+    await show_subscription_prompt(user_id, missing, bot, referral_id)
+    return False
+
+async def run_start_gates(user: types.User, chat_id: int, bot: Bot, referral_id=None) -> bool:
+    # SubGram и каналы ОП проверяются параллельно, решение принимается в порядке приоритета SubGram -> каналы ОП.
+    # Flyer показывает свои задания сам, поэтому его запрашиваем только после того, как обе проверки пройдены.
+    channels = op_channels.ids()
+    checks = {
+        "subgram": asyncio.create_task(fetch_op(
+            user.id, chat_id, user.first_name, user.language_code,
+            is_premium=getattr(user, 'is_premium', None)
+        )),
+    }
+    if channels:
+        checks["op"] = asyncio.create_task(fetch_subscription(user.id, channels, bot))
+
+    try:
+        result = await checks["subgram"]
+        if result["status"] != 'ok':
+            await show_op_result(result, chat_id, bot, ref_id=referral_id)
             return False
 
-    if builder.export():
-        markup: InlineKeyboardMarkup = builder.as_markup()
-        check_data = f"check_subs:{referral_id}" if referral_id else "check_subs"
-        check_button = InlineKeyboardButton(text="✅ Проверить подписку", callback_data=check_data)
-        markup.inline_keyboard.append([check_button])
+        if "op" in checks:
+            missing = await checks["op"]
+            if missing != []:
+                await show_subscription_prompt(user.id, missing, bot, referral_id)
+                return False
 
-        await bot.send_photo(
-            chat_id=user_id,
-            photo=FSInputFile('photo/check_sub.png'),
-            caption="<b>👋🏻 Добро пожаловать\n\nПодпишитесь на каналы, чтобы продолжить!</b>",
-            parse_mode='HTML',
-            reply_markup=markup
-        )
-        return False
+        if flyer_status[0]:
+            passed = await flyer_check(key=FLYER_TOKEN, user_id=user.id, lang_code=user.language_code)
+            if passed is None:
+                await bot.send_message(chat_id, GATE_BLOCK_ALERTS["unavailable"])
+            if not passed:
+                return False
 
-    return True
+        return True
+    finally:
+        for task in checks.values():
+            task.cancel()
 
-async def flyer_check(key: str, user_id: int, lang_code: str):
+async def flyer_check(key: str, user_id: int, lang_code: str) -> bool | None:
+    # None — Flyer недоступен, а его breaker настроен не пропускать пользователей
     if user_id in admins_id:
         return True
-    
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "key": key,
-            "user_id": user_id,
-            "language_code": lang_code,
-            "message": {
-                "text": "<b>Для продолжения использования бота подпишись на следующие каналы наших спонсоров</b>\n\n<blockquote><b>💜Спасибо за то что вы выбрали НАС</b></blockquote>",
-                "button_bot": "Запустить",
-                "button_channel": "Подписаться",
-                "button_url": "Перейти",
-                "button_boost": "Забустить",
-                "button_fp": "Выполнить"
-            }
+
+    cached = gate_cache.get("flyer", user_id)
+    if cached is not None:
+        return cached
+
+    breaker = breakers["flyer"]
+    fallback = True if breaker.fail_open else None
+    if not breaker.allow():
+        return fallback
+
+    payload = {
+        "key": key,
+        "user_id": user_id,
+        "language_code": lang_code,
+        "message": {
+            "text": "<b>Для продолжения использования бота подпишись на следующие каналы наших спонсоров</b>\n\n<blockquote><b>💜Спасибо за то что вы выбрали НАС</b></blockquote>",
+            "button_bot": "Запустить",
+            "button_channel": "Подписаться",
+            "button_url": "Перейти",
+            "button_boost": "Забустить",
+            "button_fp": "Выполнить"
         }
+    }
 
-        async with session.post("https://api.flyerservice.io/check", json=payload) as response:
+    try:
+        async with http_sessions.get("flyer").post("https://api.flyerservice.io/check", json=payload) as response:
 
             if response.status != 200:
                 print(f"Flyer API error: status {response.status}")
-                return False
+                breaker.failure()
+                return fallback
             
             data = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"Flyer API error: {e!r}")
+        breaker.failure()
+        return fallback
 
-            if data.get("skip"):
-                return True
-            else:
-                return False
-
-    
+    breaker.success()
+    passed = bool(data.get("skip"))
+    gate_cache.set("flyer", user_id, passed, passed)
+    return passed
 
 async def handle_referral_bonus(ref_id: int, user_id: int, bot: Bot):
     try:
         add_stars(ref_id, stars_reffer[0])
+        url = create_url_referral(ref_id)
         markup_back_inline = InlineKeyboardBuilder()
-        markup_back_inline.button(text="📤 Поделиться ссылкой", url=f"https://t.me/share/url?url={(await create_url_referral(bot, ref_id))}")
+        markup_back_inline.button(text="📤 Поделиться ссылкой", url=f"https://t.me/share/url?url={url}")
         markup_back = markup_back_inline.as_markup()
-        await bot.send_message(ref_id, f"🎉 Пользователь <code>{user_id}</code> зарегистрировался по вашей реферальной ссылке!\n\nВы получили <code>{stars_reffer[0]}</code>⭐️ за реферала!\n\n<b>Ссылка для приглашения:</b> \n<code>{(await create_url_referral(bot, ref_id))}</code>", parse_mode='HTML', reply_markup=markup_back)
+        await bot.send_message(ref_id, f"🎉 Пользователь <code>{user_id}</code> зарегистрировался по вашей реферальной ссылке!\n\nВы получили <code>{stars_reffer[0]}</code>⭐️ за реферала!\n\n<b>Ссылка для приглашения:</b> \n<code>{url}</code>", parse_mode='HTML', reply_markup=markup_back)
     except Exception as e:
         print(f"Referral bonus error: {e}")
 
-async def create_url_referral(bot: Bot, user_id: int):
-    return f"https://t.me/{(await bot.me()).username}?start={user_id}"
+def create_url_referral(user_id: int) -> str:
+    return f"{bot_metadata.url}?start={user_id}"
 
 async def safe_edit_message(bot, chat_id, message_id, new_text, reply_markup=None):
     try:
@@ -2504,17 +3453,397 @@ async def safe_edit_message(bot, chat_id, message_id, new_text, reply_markup=Non
         if "message is not modified" not in str(e):
             raise
 
-async def main():
-    bot = Bot(token=TOKEN)
-    dp = Dispatcher()
-    dp.message.middleware(AntiFloodMiddleware(limit=1))
-    dp.callback_query.middleware(AntiFloodMiddleware(limit=1))
+async def retention_loop():
+    while True:
+        try:
+            moved = await asyncio.to_thread(archive_old_logs, log_retention_days[0])
+            if any(moved.values()):
+                logging.info(f"Архивация логов старше {log_retention_days[0]} дн.: {moved}")
+        except Exception as e:
+            logging.exception(f"Ошибка архивации логов: {e}")
+        await asyncio.sleep(retention_interval_hours * 3600)
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, flush_interval: float = 0.05, cache_size: int = 10_000, max_retries: int = 5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.max_retries = max_retries
+        self.key_builder = DefaultKeyBuilder()
+        # Чтение идёт в цикле событий, запись пачками в потоке — у каждого своё соединение
+        self._reader = init_fsm_db(path)
+        self._writer = init_fsm_db(path)
+        self._cache: OrderedDict[str, tuple[str | None, dict]] = OrderedDict()
+        self._dirty: Dict[str, tuple[str | None, dict]] = {}
+        self._flushing: Dict[str, tuple[str | None, dict]] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._closing = False
+
+    def _read(self, key: StorageKey) -> tuple[str | None, dict]:
+        name = self.key_builder.build(key)
+        for layer in (self._dirty, self._flushing, self._cache):
+            record = layer.get(name)
+            if record is not None:
+                break
+        else:
+            record = load_fsm_record(self._reader, name) or (None, {})
+        self._remember(name, record)
+        return record
+
+    def _remember(self, name: str, record: tuple[str | None, dict]):
+        self._cache[name] = record
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _write(self, key: StorageKey, state: str | None, data: dict):
+        name = self.key_builder.build(key)
+        self._remember(name, (state, data))
+        self._dirty[name] = (state, data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # При ошибках повторяем с нарастающей паузой, но не бесконечно: несохранённое остаётся в памяти
+        # и уйдёт со следующим изменением или при остановке
+        failures = 0
+        while self._dirty and not self._closing:
+            await asyncio.sleep(self.flush_interval * 2 ** failures)
+            if await self.flush():
+                failures = 0
+                continue
+            failures += 1
+            if failures >= self.max_retries:
+                logging.error(f"Состояния FSM не сохранены после {failures} попыток, ждут следующего изменения: {len(self._dirty)}")
+                return
+
+    async def flush(self) -> bool:
+        if not self._dirty:
+            return True
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            skipped = await asyncio.to_thread(save_fsm_records, self._writer, self._flushing)
+            for name, error in skipped.items():
+                logging.error(f"Состояние FSM {name} не сохранено: данные не сериализуются в JSON ({error})")
+            return True
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояния FSM: {e!r}")
+            for name, record in self._flushing.items():
+                self._dirty.setdefault(name, record)
+            return False
+        finally:
+            self._flushing = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        self._write(key, state, self._read(key)[1])
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._read(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._write(key, self._read(key)[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._read(key)[1])
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._flush_task is not None:
+            await self._flush_task
+        if not await self.flush():
+            logging.error(f"Состояния FSM не сохранены при остановке, потеряно записей: {len(self._dirty)}")
+        self._reader.close()
+        self._writer.close()
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(FSM_DATABASE_NAME)
+    return MemoryStorage()
+
+def create_dispatcher() -> tuple[Dispatcher, SlidingWindowLimiter | SQLiteFloodBackend]:
+    dp = Dispatcher(storage=make_fsm_storage())
+    dp.startup.register(bot_metadata.refresh)
+    dp.startup.register(runtime_config.refresh)
+    dp.update.outer_middleware(DedupMiddleware(DEDUP_CAPACITY))
+    dp.update.outer_middleware(PriorityMiddleware(update_scheduler))
+    flood_backend = make_flood_backend()
+    anti_flood = AntiFloodMiddleware(flood_limits, flood_backend)
+    dp.message.middleware(anti_flood)
+    dp.callback_query.middleware(anti_flood)
+    dp.callback_query.middleware(GateMiddleware())
+    user_lock = UserLockMiddleware(user_locks)
+    dp.message.middleware(user_lock)
+    dp.callback_query.middleware(user_lock)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    return dp, flood_backend
+
+def create_webhook_app(bot: Bot, dp: Dispatcher, secret: str) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = web.AppRunner(create_webhook_app(bot, dp, secret), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        # Сервер уже слушает, поэтому переключение с polling не теряет обновлений:
+        # Telegram держит очередь, пока вебхук не установлен, и сразу начинает слать в него
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Вебхук запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def start_background_tasks(bot: Bot, flood_backend, primary: bool = True) -> list[asyncio.Task]:
+    tasks = [
+        asyncio.create_task(delayed_sender.run()),
+        asyncio.create_task(scheduler_metrics_loop()),
+        asyncio.create_task(bot_metadata.run(bot)),
+        asyncio.create_task(runtime_config.run()),
+    ]
+    if primary:
+        tasks.append(asyncio.create_task(broadcast_scheduler.run(bot)))
+        tasks.append(asyncio.create_task(retention_loop()))
+    if isinstance(flood_backend, SQLiteFloodBackend):
+        tasks.append(asyncio.create_task(flood_backend.run()))
+    return tasks
+
+def update_user_id(raw: dict) -> int:
+    for key, event in raw.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or (event.get("new_chat_member") or {}).get("user") or event.get("chat") or {}
+        return user.get("id", 0)
+    return 0
+
+def update_shard(raw: dict, workers: int) -> int:
+    # Все обновления одного пользователя попадают в один процесс, поэтому их порядок сохраняется,
+    # а антифлуд, кэши проверок и FSM в памяти процесса остаются корректными.
+    # Админы всегда в воркере 0: там работает планировщик рассылок.
+    user_id = update_user_id(raw)
+    if user_id in admins_id:
+        return 0
+    return user_id % workers
+
+class UpdateWorker:
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self._tails: Dict[int, asyncio.Task] = {}
+
+    async def _process(self, raw: dict, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.dp.feed_raw_update(self.bot, raw)
+        except Exception as e:
+            logging.exception(f"Ошибка обработки обновления {raw.get('update_id')}: {e}")
+
+    def _release(self, user_id: int, task: asyncio.Task):
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    def feed(self, raw: dict):
+        # Разные пользователи обрабатываются параллельно, обновления одного — строго по очереди
+        user_id = update_user_id(raw)
+        task = asyncio.create_task(self._process(raw, self._tails.get(user_id)))
+        self._tails[user_id] = task
+        task.add_done_callback(lambda t: self._release(user_id, t))
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+async def run_worker(index: int, queue: multiprocessing.Queue):
+    bot = create_bot()
+    await http_sessions.start()
+    dp, flood_backend = create_dispatcher()
+    background_tasks = start_background_tasks(bot, flood_backend, primary=index == 0)
+    worker = UpdateWorker(bot, dp)
+    await dp.emit_startup(bot=bot)
+    logging.info(f"Воркер {index} запущен (pid {os.getpid()})")
+    try:
+        while True:
+            batch = await asyncio.to_thread(queue.get)
+            if batch is None:
+                break
+            for raw in batch:
+                worker.feed(raw)
+        await worker.drain()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await dp.emit_shutdown(bot=bot)
+        await http_sessions.close()
+        await bot.session.close()
+
+def worker_process(index: int, queue: multiprocessing.Queue):
+    try:
+        asyncio.run(run_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+class WorkerPool:
+    def __init__(self, workers: int):
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes = [self._spawn(index) for index in range(workers)]
+        self.restarts: deque[float] = deque()
+
+    def _spawn(self, index: int):
+        process = self.context.Process(target=worker_process, args=(index, self.queues[index]), name=f"worker-{index}")
+        process.start()
+        return process
+
+    def dispatch(self, updates: list[dict]):
+        batches: Dict[int, list[dict]] = {}
+        for raw in updates:
+            batches.setdefault(update_shard(raw, len(self.queues)), []).append(raw)
+        for shard, batch in batches.items():
+            self.queues[shard].put(batch)
+
+    def restart_dead(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+
+            now = time.monotonic()
+            limit, window = WORKER_RESTART_LIMIT
+            while self.restarts and now - self.restarts[0] > window:
+                self.restarts.popleft()
+            if len(self.restarts) >= limit:
+                raise RuntimeError(f"Воркер {index} завершился с кодом {process.exitcode}: уже {limit} перезапусков за {window} сек, супервизор останавливается")
+            self.restarts.append(now)
+
+            # Новая очередь: упавший процесс мог оставить захваченной блокировку чтения старой.
+            # Накопившиеся обновления переносим, сколько удаётся забрать за короткое ожидание.
+            old_queue = self.queues[index]
+            self.queues[index] = self.context.Queue()
+            moved = 0
+            while True:
+                try:
+                    batch = old_queue.get(timeout=0.2)
+                except Empty:
+                    break
+                if batch is not None:
+                    self.queues[index].put(batch)
+                    moved += len(batch)
+
+            logging.error(f"Воркер {index} (pid {process.pid}) завершился с кодом {process.exitcode}, перезапуск (перенесено обновлений: {moved})")
+            self.processes[index] = self._spawn(index)
+
+    async def monitor(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.restart_dead()
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+async def supervise_polling(pool: WorkerPool, poll_timeout: int = 30):
+    url = f"https://api.telegram.org/bot{TOKEN}"
+    allowed_updates = router.resolve_used_update_types()
+    offset = None
+    async with ClientSession(timeout=aiohttp.ClientTimeout(total=poll_timeout + 10)) as session:
+        async with session.post(f"{url}/deleteWebhook") as response:
+            await response.read()
+        while True:
+            payload = {"timeout": poll_timeout, "allowed_updates": allowed_updates}
+            if offset is not None:
+                payload["offset"] = offset
+            try:
+                async with session.post(f"{url}/getUpdates", json=payload) as response:
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Ошибка получения обновлений: {e!r}")
+                await asyncio.sleep(1)
+                continue
+
+            if not data.get("ok"):
+                logging.error(f"getUpdates вернул ошибку: {data.get('description')}")
+                await asyncio.sleep(data.get("parameters", {}).get("retry_after", 1))
+                continue
+
+            updates = data["result"]
+            if updates:
+                offset = updates[-1]["update_id"] + 1
+                pool.dispatch(updates)
+
+async def supervise_webhook(pool: WorkerPool):
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    async def handle(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+            return web.Response(status=401)
+        pool.dispatch([await request.json()])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    bot = Bot(token=TOKEN)
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=router.resolve_used_update_types(),
+        )
+        logging.info(f"Вебхук супервизора запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+async def supervise(pool: WorkerPool):
+    receiver = supervise_webhook(pool) if RUN_MODE == "webhook" else supervise_polling(pool)
+    await asyncio.gather(pool.monitor(), receiver)
+
+def run_supervisor(workers: int):
+    pool = WorkerPool(workers)
+    logging.info(f"Супервизор запущен: {workers} воркеров")
+
+    try:
+        asyncio.run(supervise(pool))
+    finally:
+        pool.stop()
+
+async def main():
+    bot = create_bot()
+    await http_sessions.start()
+    dp, flood_backend = create_dispatcher()
+    background_tasks = start_background_tasks(bot, flood_backend)
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await http_sessions.close()
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if WORKERS > 1:
+            run_supervisor(WORKERS)
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("*" * 100)
         print("Бот остановлен. Спасибо за использование. Developed by @kalipsom | @meroqty")
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+
+class MockBotAPI:
+    def __init__(
+        self,
+        latency_ms: float = 40.0,
+        jitter_ms: float = 20.0,
+        rate_limit: float = 30.0,
+        retry_after: int = 1,
+        blocked_share: float = 0.05,
+        seed: int = 0
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked_share = blocked_share
+        self.random = random.Random(seed)
+
+        self.message_id = 0
+        self.tokens = rate_limit
+        self.last_refill = time.monotonic()
+        self.stats = {"requests": 0, "sent": 0, "flood_429": 0, "blocked_403": 0}
+
+        self.me = {"id": 100000001, "is_bot": True, "first_name": "MockBot", "username": "mock_bot"}
+
+    def is_blocked(self, chat_id: int) -> bool:
+        return (chat_id * 2654435761 % 1000) < self.blocked_share * 1000
+
+    def take_token(self) -> bool:
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def message(self, chat_id: int, **fields) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.me,
+            **fields
+        }
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        method = request.match_info["method"].lower()
+        data = await request.post()
+
+        delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        if method == "getme":
+            return self.ok(self.me)
+
+        chat_id = int(data.get("chat_id", 0))
+
+        if method in ("sendmessage", "sendphoto"):
+            if not self.take_token():
+                self.stats["flood_429"] += 1
+                return self.error(
+                    429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+                )
+            if self.is_blocked(chat_id):
+                self.stats["blocked_403"] += 1
+                return self.error(403, "Forbidden: bot was blocked by the user")
+
+            self.stats["sent"] += 1
+            if method == "sendphoto":
+                photo = [{"file_id": "mock-photo", "file_unique_id": "mock-photo", "width": 1, "height": 1}]
+                return self.ok(self.message(chat_id, photo=photo, caption=data.get("caption", "")))
+            return self.ok(self.message(chat_id, text=data.get("text", "")))
+
+        if method == "editmessagetext":
+            return self.ok(self.message(chat_id, text=data.get("text", "")))
+
+        return self.ok(True)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="средняя задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="разброс задержки")
+    parser.add_argument("--rate-limit", type=float, default=30.0, help="сообщ/сек до ответа 429 (0 — без лимита)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429")
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля пользователей, заблокировавших бота")
+
+
+def mock_from_args(args: argparse.Namespace) -> MockBotAPI:
+    return MockBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        blocked_share=args.blocked
+    )
+
+
+async def serve(args: argparse.Namespace):
+    mock = mock_from_args(args)
+    runner = await mock.start(args.host, args.port)
+    print(f"Mock Bot API запущен: http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        print(f"Статистика: {mock.stats}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальный mock Telegram Bot API (sendMessage/sendPhoto)")
+    add_mock_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -9,6 +9,52 @@ admins_id = [
 
 ALLOWED_LANGUAGE_CODES = {"uk", "be", "uz", "ru"} # Допустимые языки (ДЛЯ ПВО ПРОТИВ БОТОВ)
 
+RUN_MODE = "polling" # как получать обновления: "polling" или "webhook"
+WEBHOOK_URL = "https://example.com" # публичный https-адрес сервера, на который Telegram будет слать обновления
+WEBHOOK_PATH = "/webhook" # путь вебхука
+WEBHOOK_HOST = "0.0.0.0" # адрес, на котором слушает встроенный сервер
+WEBHOOK_PORT = 8080 # порт встроенного сервера
+WEBHOOK_SECRET = "" # секретный токен вебхука (пусто — новый случайный при каждом запуске)
+WORKERS = 1 # сколько процессов-обработчиков; больше 1 — супервизор получает обновления и раздаёт их воркерам по id пользователя
+WORKER_RESTART_LIMIT = (5, 60) # упавший воркер перезапускается; больше 5 падений за 60 сек — супервизор останавливается
+CONFIG_REFRESH_INTERVAL = 3 # раз во сколько сек воркеры перечитывают настройки, изменённые из админки
+# Настройки, изменённые из админки (подписки, награды, вывод), хранятся в БД и после перезапуска берутся оттуда, а не из этого файла
+
+flood_limits = { # антифлуд: сколько событий разрешено за период (сек), отдельно на каждого пользователя
+    "spin_slot": (2, 3), # прокрут слотов
+    "callback": (6, 3),  # остальные кнопки (навигация)
+    "message": (4, 3),   # сообщения
+}
+FLOOD_BACKEND = "memory" # где хранить счётчики антифлуда: "memory" (один процесс) или "sqlite" (общие для нескольких процессов)
+FLOOD_DATABASE_NAME = "flood.db" # файл счётчиков для FLOOD_BACKEND = "sqlite"
+FSM_STORAGE = "sqlite" # где хранить состояния диалогов (FSM): "memory" (теряются при перезапуске) или "sqlite"
+FSM_DATABASE_NAME = "fsm.db" # файл состояний для FSM_STORAGE = "sqlite"
+
+UPDATE_CONCURRENCY = 64 # сколько обновлений обрабатывается одновременно; остальные ждут в очереди по приоритету (оплаты — без очереди)
+UPDATE_WAIT_BUDGET = { # сколько сек обновление может ждать в очереди, прежде чем его отбросят (None — ждать всегда)
+    "high": None,  # действия админов с выводами, события подписки на каналы ОП
+    "normal": None, # обычные кнопки, сообщения и ввод в диалогах — не отбрасываются
+    "low": 2,      # топы и справочные экраны
+}
+LOW_PRIORITY_CALLBACKS = {"top", "top_week", "slots_info"} # кнопки, которые первыми откладываются и отбрасываются при перегрузке
+DEDUP_CAPACITY = 10000 # сколько последних update_id / id нажатий помнить, чтобы не обработать повторную доставку дважды
+
+HTTP_POOLS = { # пулы keep-alive соединений к внешним API: (соединений на хост, таймаут запроса в сек)
+    "subgram": (50, 5),
+    "flyer": (50, 5),
+    "telegram": (10, 10),
+}
+OUTBOUND_RATE = 30 # сколько сообщений в сек бот отправляет суммарно (ответы пользователям идут раньше рассылки)
+# При WORKERS > 1 лимит делится поровну: каждый воркер отправляет не больше OUTBOUND_RATE / WORKERS в сек, рассылка из воркера 0 тоже
+OUTBOUND_CHAT_LIMIT = (3, 1.0) # на один чат: сколько сообщений подряд без паузы и сколько в сек дальше
+CIRCUIT_BREAKERS = { # (ошибок подряд до отключения, пауза до пробного запроса в сек, пропускать пользователей при сбое)
+    "subgram": (5, 30, True),
+    "flyer": (5, 30, False),
+}
+HEDGE_DELAY = { # через сколько сек без ответа отправить к провайдеру второй такой же запрос и взять первый ответ
+    "subgram": 1.5, # Flyer не дублируем: он сам отправляет пользователю задание, второй запрос прислал бы его дважды
+}
+
 admin_url = "https://t.me/lound_ceo" # ссылка на админа
 
 stars_reffer = [3] # награда за реферала
@@ -17,6 +63,13 @@ photos_to_withdraw = [0] # необходимое кол-во проданных
 
 subgram_status = [True] # статус вызова subgram на кнопки
 flyer_status = [True] # статус вызова flyer на кнопки / start
+gate_cache_ttl = [60] # сколько сек помнить, что пользователь прошёл проверку subgram / flyer
+gate_cache_negative_ttl = [5] # сколько сек помнить непройденную проверку (сбрасывается кнопкой "✅ Я подписан")
+op_member_ttl = [3600] # сколько сек доверять сохранённой подписке (channel_members), прежде чем перепроверить её через API
+op_check_concurrency = 5 # сколько каналов ОП проверять одновременно
+
+log_retention_days = [30] # сколько дней хранить slots_logger / promocode_uses в основной БД (старое уходит в archive.db)
+retention_interval_hours = 6 # как часто запускать архивацию
 
 channel_osn = "https://t.me/geghl" #Основной канал (ссылка)
 
@@ -29,6 +82,8 @@ mini_games = [
     10, # Мини-Игра [Слоты] (Стоимость прокрута в звёздах)
 ]
 
+slot_result_delay = 2 # задержка сообщения с результатом слотов (сек), пока крутится анимация
+
 reward_games = {
     "slots": {
         "reward_table": {
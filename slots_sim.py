@@ -0,0 +1,102 @@
+import numpy as np
+
+SLOT_SYMBOLS = ["BAR", "🍇", "🍋", "7️⃣"]
+SLOT_OUTCOMES = 64
+
+
+def get_combo_text(dice_value: int) -> list[str]:
+    dice_value -= 1
+    result = []
+
+    for _ in range(3):
+        result.append(SLOT_SYMBOLS[dice_value % 4])
+        dice_value //= 4
+
+    return result[::-1]
+
+
+def payout_vector(reward_table: dict, default_reward: float = 0) -> np.ndarray:
+    payouts = np.full(SLOT_OUTCOMES, float(default_reward))
+    for value, reward in reward_table.items():
+        payouts[int(value) - 1] = float(reward)
+    return payouts
+
+
+def exact_stats(cost: float, reward_table: dict, default_reward: float = 0) -> dict:
+    payouts = payout_vector(reward_table, default_reward)
+    mean = payouts.mean()
+    return {
+        "cost": cost,
+        "rtp": mean / cost if cost else float("inf"),
+        "house_edge": cost - mean,
+        "win_rate": float((payouts > 0).mean()),
+        "std": float(payouts.std()),
+        "max_payout": float(payouts.max()),
+    }
+
+
+def monte_carlo(
+    cost: float,
+    reward_table: dict,
+    default_reward: float = 0,
+    paths: int = 1000,
+    spins: int = 10_000,
+    chunk: int = 1000,
+    seed: int | None = None
+) -> dict:
+    payouts = payout_vector(reward_table, default_reward)
+    house_net = cost - payouts
+    rng = np.random.default_rng(seed)
+
+    balance = np.zeros(paths)
+    drawdown = np.zeros(paths)
+    done = 0
+    while done < spins:
+        step = min(chunk, spins - done)
+        outcomes = rng.integers(0, SLOT_OUTCOMES, size=(paths, step), dtype=np.uint8)
+        path = balance[:, None] + np.cumsum(house_net[outcomes], axis=1)
+        drawdown = np.minimum(drawdown, path.min(axis=1))
+        balance = path[:, -1]
+        done += step
+
+    return {
+        "paths": paths,
+        "spins": spins,
+        "mean": float(balance.mean()),
+        "p01": float(np.percentile(balance, 1)),
+        "p05": float(np.percentile(balance, 5)),
+        "loss_probability": float((balance < 0).mean()),
+        "worst_drawdown": float(drawdown.min()),
+    }
+
+
+def simulate_slots(cost: float, reward_table: dict, default_reward: float = 0, **mc_kwargs) -> dict:
+    report = exact_stats(cost, reward_table, default_reward)
+    report["mc"] = monte_carlo(cost, reward_table, default_reward, **mc_kwargs)
+    return report
+
+
+def format_report(report: dict) -> str:
+    mc = report["mc"]
+    return (
+        f"📈 <b>RTP:</b> {report['rtp'] * 100:.1f}% | <b>Преимущество бота:</b> {report['house_edge']:+.2f} ⭐ за прокрут\n"
+        f"🎯 <b>Шанс выигрыша:</b> {report['win_rate'] * 100:.2f}% | <b>σ выплаты:</b> {report['std']:.2f} ⭐\n"
+        f"🎲 <b>Симуляция</b> {mc['paths']}×{mc['spins']} прокрутов:\n"
+        f"<blockquote>Итог бота в среднем: {mc['mean']:+.0f} ⭐\n"
+        f"Худшие 1% / 5%: {mc['p01']:+.0f} / {mc['p05']:+.0f} ⭐\n"
+        f"Вероятность минуса: {mc['loss_probability'] * 100:.1f}%\n"
+        f"Макс. просадка: {mc['worst_drawdown']:+.0f} ⭐</blockquote>"
+    )
+
+
+if __name__ == '__main__':
+    import time
+    from settings import mini_games, reward_games
+
+    config = reward_games["slots"]
+    started = time.perf_counter()
+    result = simulate_slots(mini_games[0], config["reward_table"], config.get("default_reward", 0))
+    elapsed = time.perf_counter() - started
+
+    print(format_report(result))
+    print(f"\n{result['mc']['paths'] * result['mc']['spins']:,} прокрутов за {elapsed:.2f} сек")
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from mock_bot_api import add_mock_arguments, mock_from_args
+from main import create_dispatcher, create_webhook_app, WEBHOOK_PATH
+
+SECRET = "selftest-secret"
+
+
+def synthetic_update(update_id: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": "games",
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu"
+            }
+        }
+    }
+
+
+async def wait_for(predicate, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+async def run(args: argparse.Namespace):
+    mock = mock_from_args(args)
+    mock_runner = await mock.start(args.host, args.port)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://{args.host}:{args.port}"))
+    bot = Bot(token="123456:MOCK-TOKEN", session=session)
+    dp, _ = create_dispatcher()
+    runner = web.AppRunner(create_webhook_app(bot, dp, SECRET), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.webhook_port).start()
+
+    url = f"http://{args.host}:{args.webhook_port}{WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    ok = True
+    try:
+        async with aiohttp.ClientSession() as client:
+            async with client.post(url, json=synthetic_update(1, 1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                rejected = response.status == 401
+            print(f"Неверный секрет отклонён (401): {'да' if rejected else 'НЕТ'}")
+            ok &= rejected
+
+            # Каждое обновление "games" отправляет одно sendPhoto, по нему и считаем обработку
+            sent_before = mock.stats["sent"]
+            semaphore = asyncio.Semaphore(args.concurrency)
+            statuses = []
+
+            async def post(update_id: int):
+                async with semaphore:
+                    async with client.post(url, json=synthetic_update(update_id, 1_000_000 + update_id), headers=headers) as response:
+                        statuses.append(response.status)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(2, args.updates + 2)))
+            accepted = time.perf_counter() - started
+            processed = await wait_for(lambda: mock.stats["sent"] - sent_before >= args.updates, args.timeout)
+            elapsed = time.perf_counter() - started
+
+        accepted_ok = statuses.count(200) == args.updates
+        ok &= accepted_ok and processed
+
+        print(f"Принято (200):        {statuses.count(200)} / {args.updates}")
+        print(f"Приём:                {args.updates / accepted:.1f} обновл/сек ({accepted:.2f} сек)")
+        print(f"Обработано:           {mock.stats['sent'] - sent_before} / {args.updates}")
+        print(f"От первого POST до последнего ответа бота: {elapsed:.2f} сек ({args.updates / elapsed:.1f} обновл/сек)")
+        print(f"Mock API:             {mock.stats}")
+    finally:
+        await runner.cleanup()
+        await mock_runner.cleanup()
+
+    print("Самопроверка вебхука пройдена" if ok else "Самопроверка вебхука НЕ пройдена")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Самопроверка режима вебхука на синтетических обновлениях")
+    add_mock_arguments(parser)
+    parser.set_defaults(rate_limit=0, blocked=0)
+    parser.add_argument("--webhook-port", type=int, default=8090, help="порт тестового сервера вебхука")
+    parser.add_argument("--updates", type=int, default=500, help="количество синтетических обновлений")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST-запросов")
+    parser.add_argument("--timeout", type=float, default=30, help="сколько ждать обработки (сек)")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    if not asyncio.run(run(args)):
+        raise SystemExit(1)